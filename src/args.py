@@ -1,6 +1,6 @@
 from argparse import ArgumentParser
 
-from constants import AUDIO_FEATURES, AUDIO_ANALYSIS
+from constants import AUDIO_FEATURES, AUDIO_ANALYSIS, TRACK_INDEX
 
 
 def add_list_parser(sub_parsers):
@@ -20,12 +20,43 @@ def add_list_parser(sub_parsers):
     list_sub_parser.add_argument('-N', default=0, type=int, help='''
         The amount of tracks to fetch.
     ''')
+    list_sub_parser.add_argument('--index-dir', default=TRACK_INDEX, type=str, help='''
+        The location of the track id index made by the index command. Track ids are read from it when it exists.
+    ''')
+    list_sub_parser.add_argument('--sample', action='store_true', help='''
+        Draw track ids from the index in a random order, rather than in order of appearance in the dataset.
+    ''')
+    list_sub_parser.add_argument('--seed', default=0, type=int, help='''
+        Seed for drawing track ids with --sample.
+    ''')
+
+
+def add_index_parser(sub_parsers):
+    index_sub_parser = sub_parsers.add_parser('index', help='''
+        Scan the Spotify Million Playlist Dataset once and write the distinct track ids in it, with the amount of times
+        they occur, to a compact index that the list command reads from
+    ''')
+    index_sub_parser.add_argument('--mpl-dir', default='spotify_million_playlist_dataset/data', type=str, help='''
+        The location of the Spotify Million Playlist Dataset
+    ''')
+    index_sub_parser.add_argument('--index-dir', default=TRACK_INDEX, type=str, help='''
+        The directory to write the index to.
+    ''')
+    index_sub_parser.add_argument('--workers', default=4, type=int, help='''
+        The amount of processes that parse slices of the dataset.
+    ''')
 
 
 def add_fetch_parser(sub_parsers):
     fetch_sub_parser = sub_parsers.add_parser('fetch', help='''
         Resume fetching data from the Spotify API to put into a dataset. Expects OUTPUT_DIR to contain a valid meta file
     ''')
+    fetch_sub_parser.add_argument('--concurrency', default=8, type=int, help='''
+        The amount of requests to have in flight at the same time.
+    ''')
+    fetch_sub_parser.add_argument('--rate', default=20.0, type=float, help='''
+        The maximum amount of requests per second, shared by all concurrent requests.
+    ''')
 
 
 def add_check_parser(sub_parsers):
@@ -77,6 +108,29 @@ def add_obsolete_parser(sub_parsers):
     )
 
 
+def add_reindex_parser(sub_parsers):
+    reindex_sub_parser = sub_parsers.add_parser('reindex', help='''
+        Rebuild the manifest of the data points in OUTPUT_DIR from the files on disk, e.g. after adding or removing
+        files by hand
+    ''')
+
+
+def add_compact_parser(sub_parsers):
+    compact_sub_parser = sub_parsers.add_parser('compact', help='''
+        Pack the audio_analysis objects in OUTPUT_DIR into a single memory-mapped store
+    ''')
+    compact_sub_parser.add_argument('--quantize-chroma', action='store_true', help='''
+        Store the chroma vectors as uint8 rather than float32, which makes the store about 2.5 times smaller.
+    ''')
+
+
+def add_features_parser(sub_parsers):
+    features_sub_parser = sub_parsers.add_parser('features', help='''
+        Compute the derived features of the tracks in the packed store of OUTPUT_DIR again, e.g. after their version
+        changed. compact computes them already
+    ''')
+
+
 def get_args():
     arg_parser = ArgumentParser()
     arg_parser.add_argument('--output-dir', default='dataset', type=str, help='''
@@ -84,9 +138,13 @@ def get_args():
         ''')
     sub_parsers = arg_parser.add_subparsers(dest='command')
     add_list_parser(sub_parsers)
+    add_index_parser(sub_parsers)
     add_fetch_parser(sub_parsers)
     add_count_parser(sub_parsers)
     add_check_parser(sub_parsers)
     add_missing_parser(sub_parsers)
     add_obsolete_parser(sub_parsers)
+    add_reindex_parser(sub_parsers)
+    add_compact_parser(sub_parsers)
+    add_features_parser(sub_parsers)
     return arg_parser.parse_args()
@@ -4,6 +4,8 @@ import os
 import os.path as path
 import time
 
+from constants import get_accounts_url
+
 
 def get_client_id():
     return "1459c33d0d8f4e90b75fabbc23d36187"
@@ -20,6 +22,7 @@ def get_pickle_file_name():
 def store_token(token):
     # Time we received it (in secs) + time it lasts (in secs) is time it expires (in secs)
     token['expire_time'] = time.time() + token['expires_in']
+    token['accounts_url'] = get_accounts_url()
     with open(get_pickle_file_name(), 'wb') as f:
         pickle.dump(token, f)
 
@@ -31,15 +34,17 @@ def load_token():
 
 def fetch_new_token():
     payload = {'grant_type': 'client_credentials'}
-    r = requests.post('https://accounts.spotify.com/api/token', data=payload,
+    r = requests.post(f'{get_accounts_url()}/api/token', data=payload,
                       auth=(get_client_id(), get_client_secret()))
     return r.json()
 
 
-def get_token():
-    if (path.lexists(get_pickle_file_name())):
+def get_token(force=False):
+    if not force and path.lexists(get_pickle_file_name()):
         token = load_token()
-        if time.time() < (token['expire_time'] - 0.1):
+        # Don't use a token of another accounts server, e.g. the stand-in server
+        if token.get('accounts_url', get_accounts_url()) == get_accounts_url() and \
+                time.time() < (token['expire_time'] - 0.1):
             return token
     token = fetch_new_token()
     store_token(token)
@@ -0,0 +1,403 @@
+from argparse import ArgumentParser
+from json import dump, load
+from multiprocessing import cpu_count
+from os import environ, makedirs
+from os.path import dirname, join
+from platform import python_version
+from subprocess import run
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+import numpy as np
+from tabulate import tabulate
+
+import key_recognition
+from cascade_model import Cascade_model
+from constants import AUDIO_ANALYSIS
+from data import fetch, list_tracks, store_extracted_analysis
+from forward import BatchScorer
+from hmm_model import HMM_model
+from key_recognition import collect_data
+from manifest import Manifest
+from naive_model import Naive_model
+from process import extract_track_analysis
+from spotify_client import SpotifyClient
+from spotify_stub import add_stub_arguments, start_stub_process, synthetic_analysis
+from tracklist import TrackList
+
+
+def get_args():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--data-dir', default='dataset', type=str, help='''
+        The directory where the track data is stored to use for the benchmark.
+        ''')
+    arg_parser.add_argument('--test-split', default=5, type=int, help='''
+        Use 1/N of the data for testing
+        ''')
+    arg_parser.add_argument('--window-seconds', default=20, type=float, help='''
+        Only use the segments of the first N seconds of every track. Uses the whole track when 0.
+        ''')
+    arg_parser.add_argument('--n_components', default=3, type=int, help='''
+        Amount of components ('hidden states') to use for HMM training.
+        ''')
+    arg_parser.add_argument('--n_iter', default=100, type=int, help='''
+        (Maximum) amount of iterations used in HMM training.
+        ''')
+    sub_parsers = arg_parser.add_subparsers(dest='benchmark')
+    sub_parsers.required = True
+    sub_parsers.add_parser('predict', help='''
+        Compare the per-track prediction time of the HMM prediction engines and batched prediction.
+    ''')
+    precision_sub_parser = sub_parsers.add_parser('precision', help='''
+        Compare the accuracy and log-likelihoods of HMM training and batched scoring in float32 against float64.
+    ''')
+    precision_sub_parser.add_argument('--folds', default=3, type=int, help='''
+        The amount of folds of the test split to compare on.
+        ''')
+    early_exit_sub_parser = sub_parsers.add_parser('early-exit', help='''
+        Trade latency against accuracy: predict keys from streamed segments, stopping at log-likelihood margins.
+    ''')
+    early_exit_sub_parser.add_argument('--margins', default=[5, 10, 20, 50, 100], type=float, nargs='+', help='''
+        The log-likelihood margins between the best and second best key to stop at.
+        ''')
+    cascade_sub_parser = sub_parsers.add_parser('cascade', help='''
+        Compare the speed and accuracy of cascaded prediction, naive ranking before HMM scoring, against the full HMM.
+    ''')
+    cascade_sub_parser.add_argument('--top-k', default=[1, 2, 3, 5], type=int, nargs='+', help='''
+        The amounts of naive candidate keys to score with the HMM.
+        ''')
+    cascade_sub_parser.add_argument('--cutoffs', default=[], type=float, nargs='+', help='''
+        Naive correlation leads at which to skip the HMM, every top-k is also run without a cutoff.
+        ''')
+    cascade_sub_parser.add_argument('--give-mode', action='store_true', help='''
+        Predict with given mode (major/minor).
+        ''')
+    suite_sub_parser = sub_parsers.add_parser('suite', help='''
+        Time loading, training, prediction and cross-validation on generated datasets of several sizes.
+    ''')
+    suite_sub_parser.add_argument('--sizes', default=[200, 1000], type=int, nargs='+', help='''
+        The amounts of tracks of the generated datasets.
+        ''')
+    suite_sub_parser.add_argument('--segments', default=200, type=int, help='''
+        The amount of segments of every generated track.
+        ''')
+    suite_sub_parser.add_argument('--seed', default=0, type=int, help='''
+        Seed of the generated data.
+        ''')
+    suite_sub_parser.add_argument('--per-track', default=100, type=int, help='''
+        The amount of testing tracks to time per-track prediction on.
+        ''')
+    suite_sub_parser.add_argument('--workers', default=1, type=int, help='''
+        Amount of processes to run the cross-validation folds in.
+        ''')
+    suite_sub_parser.add_argument('--output', default='results/benchmark.json', type=str, help='''
+        JSON file to write the timings to.
+        ''')
+    suite_sub_parser.add_argument('--compare', default='', type=str, help='''
+        Optional JSON file of an earlier run, e.g. on another branch, to compare the timings against.
+        ''')
+    generate_sub_parser = sub_parsers.add_parser('generate', help='''
+        Write a deterministic synthetic dataset to DATA_DIR, in the layout of a fetched one.
+    ''')
+    generate_sub_parser.add_argument('-N', default=1000, type=int, help='''
+        The amount of tracks to generate.
+        ''')
+    generate_sub_parser.add_argument('--segments', default=200, type=int, help='''
+        The amount of segments of every track.
+        ''')
+    generate_sub_parser.add_argument('--seed', default=0, type=int, help='''
+        Seed of the generated data.
+        ''')
+    ingest_sub_parser = sub_parsers.add_parser('ingest', help='''
+        Measure the throughput of listing and fetching tracks against a local Spotify API stand-in.
+    ''')
+    ingest_sub_parser.add_argument('-N', default=1000, type=int, help='''
+        The amount of tracks to ingest.
+        ''')
+    ingest_sub_parser.add_argument('--concurrency', default=8, type=int, help='''
+        The amount of audio analysis requests to have in flight at the same time.
+        ''')
+    ingest_sub_parser.add_argument('--rate', default=1000.0, type=float, help='''
+        The maximum amount of requests per second.
+        ''')
+    add_stub_arguments(ingest_sub_parser)
+    return arg_parser.parse_args()
+
+
+def time_per_track(predict, tracks):
+    start = perf_counter()
+    estimates = np.array([predict(track) for track in tracks])
+    return (perf_counter() - start) / len(tracks), estimates
+
+
+def benchmark_predict(args):
+    training_data, testing_data = collect_data(args.data_dir, args.test_split, window_seconds=args.window_seconds)
+    model = HMM_model(n_components=args.n_components, n_iter=args.n_iter)
+    model.train(training_data)
+    model.model = model.transpose_models()
+    tracks = list(testing_data.values())
+
+    results = {}
+    for engine in ['copies', 'rolled']:
+        model.engine = engine
+        results[engine] = time_per_track(model.predict, tracks)
+    start = perf_counter()
+    estimates = model.predict_batch(tracks)
+    results['batched'] = (perf_counter() - start) / len(tracks), estimates
+    baseline = results['copies'][0]
+    print(tabulate([
+        [engine, seconds * 1000, baseline / seconds]
+        for engine, (seconds, _) in results.items()
+    ], headers=['Engine', 'ms/track', 'Speed-up'], floatfmt='.3f'))
+    for engine in ['rolled', 'batched']:
+        mismatches = np.sum(results['copies'][1] != results[engine][1])
+        print(f'{mismatches} of {len(tracks)} predictions differ between copies and {engine}')
+
+
+def benchmark_precision(args):
+    rows = []
+    for fold in range(min(args.folds, args.test_split)):
+        training_data, testing_data = collect_data(args.data_dir, args.test_split, fold,
+                                                   window_seconds=args.window_seconds)
+        tracks = list(testing_data.values())
+        labels = np.array([track['mode'] * 12 + track['key'] for track in tracks])
+        models = {}
+        baseline = None
+        # Scoring a float64 model in float32 separates the error of single precision scoring from that of training
+        for training, scoring in [('float64', 'float64'), ('float64', 'float32'), ('float32', 'float32')]:
+            train_seconds = 0
+            if training not in models:
+                models[training] = HMM_model(n_components=args.n_components, n_iter=args.n_iter, dtype=training,
+                                             workers=1)
+                start = perf_counter()
+                models[training].train(training_data)
+                train_seconds = perf_counter() - start
+            model = models[training]
+            seqs = [model.format_sequence(track) for track in tracks]
+            start = perf_counter()
+            scores = np.concatenate([BatchScorer(base_model, dtype=scoring).score(seqs)
+                                     for base_model in model.base_models], axis=1)
+            score_seconds = perf_counter() - start
+            baseline = scores if baseline is None else baseline
+            estimates = np.argmax(scores, axis=1)
+            train_log_likelihood = sum(stats['log_likelihood'] for stats in model.training_stats if stats['selected'])
+            rows.append([fold, training, scoring, np.mean(estimates != labels) * 100, train_log_likelihood,
+                         np.mean(scores[np.arange(len(tracks)), labels]), train_seconds or None,
+                         score_seconds * 1000 / len(tracks), np.sum(estimates != np.argmax(baseline, axis=1)),
+                         np.max(np.abs(scores - baseline) / np.abs(baseline))])
+    print(tabulate(rows, headers=['Fold', 'Training', 'Scoring', 'Error %', 'Train log-likelihood',
+                                  'Test log-likelihood', 'Train s', 'Score ms/track', 'Differing predictions',
+                                  'Max relative difference'], floatfmt='.6g'))
+
+
+def benchmark_early_exit(args):
+    training_data, testing_data = collect_data(args.data_dir, args.test_split, window_seconds=args.window_seconds)
+    model = HMM_model(n_components=args.n_components, n_iter=args.n_iter)
+    model.train(training_data)
+    tracks = list(testing_data.values())
+    labels = np.array([track['mode'] * 12 + track['key'] for track in tracks])
+    lengths = np.array([len(track['pitches']) for track in tracks])
+    full = model.predict_batch(tracks)
+    rows = [['full window', np.mean(full != labels) * 100, 100, np.mean(lengths), 100, None]]
+    for margin in args.margins:
+        estimates = np.empty(len(tracks), dtype=int)
+        segments_used = np.empty(len(tracks), dtype=int)
+        start = perf_counter()
+        for i, track in enumerate(tracks):
+            predictor = model.stream(margin)
+            # One segment at a time, as they would arrive
+            for segment in model.format_sequence(track):
+                if predictor.add(segment) is not None:
+                    break
+            estimates[i] = predictor.estimate()
+            segments_used[i] = predictor.segments_used
+        seconds = perf_counter() - start
+        rows.append([margin, np.mean(estimates != labels) * 100, np.mean(estimates == full) * 100,
+                     np.mean(segments_used), 100 * np.mean(segments_used / np.maximum(lengths, 1)),
+                     seconds * 1000 / len(tracks)])
+    print(tabulate(rows, headers=['Margin', 'Error %', 'Agrees with full window %', 'Segments used',
+                                  'Window used %', 'ms/track'], floatfmt='.2f'))
+
+
+def benchmark_cascade(args):
+    training_data, testing_data = collect_data(args.data_dir, args.test_split, window_seconds=args.window_seconds)
+    model = Cascade_model(HMM_model(n_components=args.n_components, n_iter=args.n_iter))
+    model.train(training_data)
+    model.get_scorers()
+    tracks = list(testing_data.values())
+    labels = np.array([track['mode'] * 12 + track['key'] for track in tracks])
+    mode = np.array([track['mode'] for track in tracks]) if args.give_mode else None
+    hmm_seconds, full = timed(model.hmm_model.predict_batch, tracks, mode)
+    naive_seconds, naive = timed(model.naive_model.predict_batch, tracks, mode)
+    rows = [
+        ['full HMM', None, np.mean(full != labels) * 100, 100, 0, 24 if mode is None else 12,
+         hmm_seconds * 1000 / len(tracks), 1],
+        ['naive', None, np.mean(naive != labels) * 100, np.mean(naive == full) * 100, 100, 0,
+         naive_seconds * 1000 / len(tracks), hmm_seconds / naive_seconds],
+    ]
+    for top_k in args.top_k:
+        for cutoff in [None] + args.cutoffs:
+            model.top_k, model.cutoff = top_k, cutoff
+            model.reset_stats()
+            seconds, estimates = timed(model.predict_batch, tracks, mode)
+            rows.append([top_k, cutoff, np.mean(estimates != labels) * 100, np.mean(estimates == full) * 100,
+                         100 * model.stats['skipped'] / len(tracks), model.stats['hmm_keys'] / len(tracks),
+                         seconds * 1000 / len(tracks), hmm_seconds / seconds])
+    print(tabulate(rows, headers=['Top-k', 'Cutoff', 'Error %', 'Agrees with full HMM %', 'HMM skipped %',
+                                  'HMM keys/track', 'ms/track', 'Speed-up'],
+                   floatfmt=('g', 'g', '.2f', '.2f', '.2f', '.2f', '.3f', '.2f')))
+
+
+def generate_dataset(output_dir, n_tracks, n_segments=200, seed=0):
+    ''' Writes n_tracks synthetic tracks as audio_analysis/ pickles and a track_list.pickle. Deterministic in the seed. '''
+    makedirs(join(output_dir, AUDIO_ANALYSIS), exist_ok=True)
+    track_ids = ['%022d' % i for i in range(n_tracks)]
+    with Manifest(output_dir) as manifest:
+        for track_id in track_ids:
+            analysis = synthetic_analysis(track_id, seed, n_segments)
+            analysis['track']['id'] = track_id
+            store_extracted_analysis(output_dir, extract_track_analysis(analysis), manifest)
+    track_list = TrackList()
+    track_list.set_track_ids(track_ids)
+    track_list.set_desired_tracks_amount(n_tracks)
+    track_list.dump(output_dir)
+
+
+def timed(function, *args, **kwargs):
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    return perf_counter() - start, result
+
+
+def load_data(args, data_dir):
+    training_data, testing_data = collect_data(data_dir, args.test_split, window_seconds=args.window_seconds)
+    return dict(training_data.items()), list(testing_data.values())
+
+
+def get_cross_validation_args(args, data_dir):
+    return key_recognition.get_args([
+        '--data-dir', data_dir, '--cross-validation', '--test-split', str(args.test_split),
+        '--workers', str(args.workers), '--window-seconds', str(args.window_seconds),
+        '--n_components', str(args.n_components), '--n_iter', str(args.n_iter), 'hmm', '--train-workers', '1',
+    ])
+
+
+def benchmark_suite(args):
+    results = []
+
+    def record(size, stage, n_tracks, seconds):
+        results.append({'size': size, 'stage': stage, 'tracks': n_tracks, 'seconds': seconds,
+                        'ms_per_track': seconds * 1000 / max(n_tracks, 1)})
+    for size in args.sizes:
+        data_dir = mkdtemp()
+        try:
+            record(size, 'generate', size, timed(generate_dataset, data_dir, size, args.segments, args.seed)[0])
+            seconds, (training_data, tracks) = timed(load_data, args, data_dir)
+            record(size, 'collect_data', size, seconds)
+
+            model = HMM_model(n_components=args.n_components, n_iter=args.n_iter, workers=1)
+            seconds, sequences = timed(model.format_training_data, training_data)
+            record(size, 'format_training_data', len(training_data), seconds)
+            seconds, base_models = timed(model.train_model, *sequences, hidden_states=args.n_components,
+                                         iterations=args.n_iter)
+            record(size, 'train_model', len(training_data), seconds)
+            model.set_base_models(base_models)
+            per_track = tracks[:args.per_track]
+            record(size, 'predict', len(per_track), timed(lambda: [model.predict(track) for track in per_track])[0])
+            record(size, 'predict_batch', len(tracks), timed(model.predict_batch, tracks)[0])
+
+            naive = Naive_model()
+            record(size, 'naive_train', len(training_data), timed(naive.train, training_data)[0])
+            record(size, 'naive_predict_batch', len(tracks), timed(naive.predict_batch, tracks)[0])
+
+            record(size, 'cross_validation', size,
+                   timed(key_recognition.run_cross_validation, get_cross_validation_args(args, data_dir))[0])
+        finally:
+            rmtree(data_dir)
+
+    commit = run(['git', 'rev-parse', '--short', 'HEAD'], cwd=dirname(__file__) or '.', capture_output=True,
+                 text=True).stdout.strip()
+    report = {
+        'commit': commit or None,
+        'python': python_version(),
+        'numpy': np.__version__,
+        'cpus': cpu_count(),
+        'args': {name: value for name, value in vars(args).items() if name not in ['output', 'compare']},
+        'results': results,
+    }
+    if dirname(args.output):
+        makedirs(dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        dump(report, f, indent=2)
+    print(tabulate([[result['size'], result['stage'], result['tracks'], result['seconds'], result['ms_per_track']]
+                    for result in results],
+                   headers=['Size', 'Stage', 'Tracks', 'Seconds', 'ms/track'], floatfmt='.3f'))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            base = load(f)
+        base_seconds = {(result['size'], result['stage']): result['seconds'] for result in base['results']}
+        print(f"\nCompared to {base['commit'] or args.compare}:")
+        print(tabulate([[result['size'], result['stage'], base_seconds[result['size'], result['stage']],
+                         result['seconds'], base_seconds[result['size'], result['stage']] / result['seconds']]
+                        for result in results if (result['size'], result['stage']) in base_seconds],
+                       headers=['Size', 'Stage', 'Base seconds', 'Seconds', 'Speed-up'], floatfmt='.3f'))
+
+
+def client_stats(stage, n_tracks, seconds, client):
+    latencies = np.array(client.latencies) * 1000
+    return [stage, n_tracks, seconds, n_tracks / seconds, len(latencies), np.percentile(latencies, 50),
+            np.percentile(latencies, 99), client.retries, client.rate_limited]
+
+
+def write_playlist_slice(mpl_data_path, track_ids):
+    # A Million Playlist Dataset slice with a single playlist of all track_ids
+    makedirs(mpl_data_path)
+    with open(join(mpl_data_path, 'mpd.slice.0-999.json'), 'w') as f:
+        dump({'playlists': [{'tracks': [{'track_uri': f'spotify:track:{track_id}'} for track_id in track_ids]}]}, f)
+
+
+def benchmark_ingest(args):
+    process, url = start_stub_process(args)
+    environ['SPOTIFY_API_URL'] = url + '/v1'
+    environ['SPOTIFY_ACCOUNTS_URL'] = url
+    work_dir = mkdtemp()
+    mpl_data_path = join(work_dir, 'mpd')
+    output_dir = join(work_dir, 'data')
+    # Listing balances the keys, so it gets more track ids than it needs
+    write_playlist_slice(mpl_data_path, ['%022d' % i for i in range(4 * args.N)])
+    try:
+        client = SpotifyClient(concurrency=1, rate=args.rate)
+        start = perf_counter()
+        list_tracks(mpl_data_path, output_dir, args.N, client=client)
+        seconds = perf_counter() - start
+        track_ids = TrackList.load_from_dir(output_dir).get_track_ids()
+        features = client_stats('audio_features', len(track_ids), seconds, client)
+
+        client = SpotifyClient(concurrency=args.concurrency, rate=args.rate)
+        start = perf_counter()
+        fetch(output_dir, args.concurrency, args.rate, client)
+        analysis = client_stats('audio_analysis', len(track_ids), perf_counter() - start, client)
+    finally:
+        process.terminate()
+        rmtree(work_dir)
+    print(tabulate([features, analysis], headers=['Stage', 'Tracks', 'Seconds', 'Tracks/s', 'Requests', 'p50 ms',
+                                                  'p99 ms', 'Retries', '429s'], floatfmt='.2f'))
+
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.benchmark == 'predict':
+        benchmark_predict(args)
+    elif args.benchmark == 'precision':
+        benchmark_precision(args)
+    elif args.benchmark == 'early-exit':
+        benchmark_early_exit(args)
+    elif args.benchmark == 'cascade':
+        benchmark_cascade(args)
+    elif args.benchmark == 'suite':
+        benchmark_suite(args)
+    elif args.benchmark == 'generate':
+        generate_dataset(args.data_dir, args.N, args.segments, args.seed)
+    elif args.benchmark == 'ingest':
+        benchmark_ingest(args)
@@ -0,0 +1,86 @@
+import numpy as np
+
+from hmm_model import HMM_model
+from naive_model import Naive_model
+
+
+class Cascade_model:
+    """
+    Ranks the keys of every track with the cheap correlation of Naive_model, and only runs HMM scoring on the top_k
+    keys of that ranking. Tracks for which the best correlation leads the second best by at least cutoff keep the
+    naive estimate and skip the HMM altogether; no track skips it when cutoff is None.
+    """
+
+    def __init__(self, hmm_model: HMM_model, top_k=3, cutoff=None):
+        self.hmm_model = hmm_model
+        self.naive_model = Naive_model()
+        self.top_k = top_k
+        self.cutoff = cutoff
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Statistics of the predictions since the last reset, for reporting the savings
+        self.stats = {'tracks': 0, 'skipped': 0, 'hmm_keys': 0}
+
+    def train(self, training_data_dict: dict, verbose=False, profiler=None):
+        self.naive_model.train(training_data_dict, verbose=verbose)
+        self.hmm_model.train(training_data_dict, verbose=verbose, profiler=profiler)
+
+    @property
+    def training_stats(self):
+        return self.hmm_model.training_stats
+
+    def save(self, path):
+        # Both models in one file, the naive arrays prefixed
+        arrays = self.hmm_model.get_arrays()
+        arrays.update({'naive_' + name: value for name, value in self.naive_model.get_arrays().items()})
+        arrays.update({'method': 'cascade', 'top_k': self.top_k,
+                       'cutoff': np.nan if self.cutoff is None else self.cutoff})
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    def load(self, path):
+        # top_k and cutoff are prediction settings, those of this object are kept
+        with np.load(path) as arrays:
+            self.hmm_model.set_arrays(arrays)
+            self.naive_model.set_arrays({name[len('naive_'):]: arrays[name]
+                                         for name in arrays.files if name.startswith('naive_')})
+        return self
+
+    def get_scorers(self):
+        return self.hmm_model.get_scorers()
+
+    def predict_batch(self, test_samples: list, mode=None):
+        return np.argmax(self.score_batch(test_samples, mode), axis=1)
+
+    def score_batch(self, test_samples: list, mode=None):
+        # HMM log-likelihoods of the candidate keys of every sample, -inf for the other keys. Samples that skip the HMM
+        # get a 0 for their naive estimate instead, so the argmax is the prediction either way.
+        naive_scores = self.naive_model.score_batch(test_samples, mode)
+        ranking = np.argsort(-naive_scores, axis=1, kind='stable')
+        rows = np.arange(len(test_samples))[:, None]
+        candidates = np.zeros(naive_scores.shape, dtype=bool)
+        candidates[rows, ranking[:, :self.top_k]] = True
+        # Keys outside a given mode are never candidates
+        candidates &= np.isfinite(naive_scores)
+        skipped = np.zeros(len(test_samples), dtype=bool)
+        if self.cutoff is not None:
+            skipped = self.get_confidence(naive_scores, ranking) >= self.cutoff
+        candidates[skipped] = False
+        scores = self.hmm_model.score_candidates(test_samples, candidates)
+        scores[skipped, ranking[skipped, 0]] = 0
+        self.stats['tracks'] += len(test_samples)
+        self.stats['skipped'] += int(skipped.sum())
+        self.stats['hmm_keys'] += int(candidates.sum())
+        return scores
+
+    @staticmethod
+    def get_confidence(naive_scores, ranking):
+        # The lead of the best correlation over the second best, infinite when only one key is allowed
+        rows = np.arange(len(naive_scores))
+        best, second = naive_scores[rows, ranking[:, 0]], naive_scores[rows, ranking[:, 1]]
+        with np.errstate(invalid='ignore'):
+            return np.where(np.isfinite(second), best - second, np.inf)
+
+    def format_sequence(self, audio_analysis):
+        return self.hmm_model.format_sequence(audio_analysis)
@@ -1,2 +1,15 @@
+from os import environ
+
 AUDIO_ANALYSIS = 'audio_analysis'
 AUDIO_FEATURES = 'audio_features'
+PACKED_STORE = 'packed'
+TRACK_INDEX = 'track_index'
+
+
+def get_api_url():
+    # Can be pointed at a stand-in server, see spotify_stub.py
+    return environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+
+
+def get_accounts_url():
+    return environ.get('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
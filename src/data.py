@@ -1,6 +1,6 @@
-import operator
 from argparse import ArgumentParser
-from functools import partial, reduce
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from math import ceil
 from os import getcwd, makedirs
 from os.path import exists, isdir, join
@@ -14,9 +14,12 @@ from halo import Halo
 
 from args import get_args
 from constants import AUDIO_ANALYSIS, AUDIO_FEATURES
+from manifest import Manifest
 from meta import Meta
-from mpl import list_track_ids, track_id_generator
+from mpl import get_track_id_generator, list_track_ids, write_index
 from process import extract_audio_features, extract_track_analysis
+from spotify_client import SpotifyClient
+from store import PackedStore, get_store_dir, have_store, write_features, write_store
 from track_analysis import n_track_analyses_generator
 from track_features import n_track_features
 from tracklist import TrackList
@@ -65,17 +68,26 @@ def start_fetching(mpl_dir, output_dir, n_tracks):
     print('done fetching')
     meta.dump(output_dir)
 
-def store_datapoint(output_dir, data_type, datapoint) -> None:
+def store_datapoint(output_dir, data_type, datapoint, manifest: Manifest = None) -> None:
+    """
+    Pickles datapoint and records it in the manifest. Callers that store many data points pass an open manifest and
+    commit it now and then, otherwise it is opened and committed for this data point alone.
+    """
     with open(get_track_data_path(output_dir, data_type, datapoint['id']), 'wb') as f:
         dump(datapoint, f)
+    if manifest is not None:
+        manifest.add(data_type, [datapoint['id']])
+    else:
+        with Manifest(output_dir) as manifest:
+            manifest.add(data_type, [datapoint['id']])
 
 
-def store_extracted_features(output_dir, extracted_audio_features) -> None:
-    store_datapoint(output_dir, AUDIO_FEATURES, extracted_audio_features)
+def store_extracted_features(output_dir, extracted_audio_features, manifest: Manifest = None) -> None:
+    store_datapoint(output_dir, AUDIO_FEATURES, extracted_audio_features, manifest)
 
 
-def store_extracted_analysis(output_dir, extracted_track_analysis) -> None:
-    store_datapoint(output_dir, AUDIO_ANALYSIS, extracted_track_analysis)
+def store_extracted_analysis(output_dir, extracted_track_analysis, manifest: Manifest = None) -> None:
+    store_datapoint(output_dir, AUDIO_ANALYSIS, extracted_track_analysis, manifest)
 
 
 def load_datapoint(output_dir, data_type, track_id) -> dict:
@@ -97,7 +109,8 @@ def get_datapoint_ids(output_dir, data_type) -> Generator:
 
 
 def count_data_points(output_dir, data_type):
-    return len(list(get_datapoint_ids(output_dir, data_type)))
+    with Manifest(output_dir) as manifest:
+        return manifest.count(data_type)
 
 
 def load_features(output_dir, track_id) -> dict:
@@ -116,24 +129,62 @@ def create_track_list(track_ids) -> TrackList:
 
 def get_n_track_ids(track_id_gen, n, have_id):
     track_ids = []
-    next_id = next(track_id_gen, None)
-    while next_id is not None and len(track_ids) < n:
-        if not have_id(next_id):
+    for next_id in track_id_gen:
+        if not have_id(next_id) and next_id not in track_ids:
             track_ids.append(next_id)
-        next_id = next(track_id_gen, None)
+            if len(track_ids) == n:
+                break
     return track_ids
 
 
-def listing_track_id_generator(output_dir, mpl_data_path, have_track_id):
+def get_key_index(features) -> int:
+    return features['key'] + (features['mode'] * 12)
+
+
+def get_features_log_path(output_dir) -> str:
+    return join(output_dir, 'audio_features.log')
+
+
+def append_features_log(output_dir, key_indices) -> None:
+    with open(get_features_log_path(output_dir), 'a') as f:
+        f.writelines(f'{track_id} {key}\n' for track_id, key in key_indices)
+
+
+def load_key_indices(output_dir) -> dict:
+    """
+    The key index (key + 12 * mode) of every stored audio features object. These are read from the features log that
+    list_tracks appends to, only objects that are missing from it are unpickled (and then added to it).
+    """
+    logged = dict()
+    if exists(get_features_log_path(output_dir)):
+        with open(get_features_log_path(output_dir), 'r') as f:
+            for line in f:
+                track_id, key = line.split()
+                logged[track_id] = int(key)
+    key_indices = dict()
+    unlogged = []
+    with Manifest(output_dir) as manifest:
+        track_ids = manifest.get_track_ids(AUDIO_FEATURES)
+    for track_id in track_ids:
+        if track_id not in logged:
+            logged[track_id] = get_key_index(load_features(output_dir, track_id))
+            unlogged.append((track_id, logged[track_id]))
+        key_indices[track_id] = logged[track_id]
+    append_features_log(output_dir, unlogged)
+    return key_indices
+
+
+def listing_track_id_generator(output_dir, mpl_data_path, have_track_id, index_dir=None, sample=False, seed=0):
     missing_tids = get_missing(output_dir, AUDIO_FEATURES)
     for tid in missing_tids:
         yield tid
-    mpl_tid_generator = track_id_generator(mpl_data_path, have_track_id)
+    mpl_tid_generator = get_track_id_generator(mpl_data_path, index_dir, have_track_id, sample, seed)
     for tid in mpl_tid_generator:
         yield tid
 
 
-def list_tracks(mpl_data_path, output_dir, n, list_dir='', _track_list: TrackList = None) -> None:
+def list_tracks(mpl_data_path, output_dir, n, list_dir='', _track_list: TrackList = None, index_dir=None,
+                sample=False, seed=0, client=None) -> None:
     spinner = Halo(text='Listing tracks', spinner='dots')
     spinner.start()
     if not exists(get_data_dir(output_dir, AUDIO_FEATURES)):
@@ -143,57 +194,92 @@ def list_tracks(mpl_data_path, output_dir, n, list_dir='', _track_list: TrackLis
     required_per_key = ceil(n / 24)
     for key in range(24):
         key_counts[key] = 0
+    # Track ids that have a features object stored or were requested already, so they are not requested again
+    listed = set()
     # Start from a provided track list or create a new one
     track_list_complete = False
     if _track_list is not None:
         track_list_complete = True
-        track_id_gen = listing_track_id_generator(output_dir, mpl_data_path, _track_list.have_track_id)
-        for id in get_datapoint_ids(output_dir, AUDIO_FEATURES):
-            f = load_features(output_dir, id)
-            key = f['key'] + (f['mode'] * 12)
+        track_id_gen = listing_track_id_generator(output_dir, mpl_data_path, _track_list.have_track_id, index_dir,
+                                                  sample, seed)
+        key_indices = load_key_indices(output_dir)
+        listed.update(key_indices)
+        for key in key_indices.values():
             key_counts[key] += 1
     else:
-        track_id_gen = track_id_generator(mpl_data_path)
+        track_id_gen = get_track_id_generator(mpl_data_path, index_dir, sample=sample, seed=seed)
         _track_list = TrackList()
         _track_list.set_desired_tracks_amount(n)
-    total = count_data_points(output_dir, AUDIO_FEATURES)
+    total = len(listed)
     _track_list.dump(output_dir)
+    client = client if client is not None else SpotifyClient(concurrency=1)
+    manifest = Manifest(output_dir)
 
     def finished():
-        return reduce(operator.and_, [key_counts[key] >= required_per_key for key in range(24)]) or \
-               count_data_points(output_dir, AUDIO_FEATURES) >= n
-    while not finished():
-        have_track = partial(have_datapoint, output_dir, AUDIO_FEATURES)
-        track_ids = get_n_track_ids(track_id_gen, 100, have_track)
-        track_feats = n_track_features(track_ids)
-        for track_feat in track_feats:
-            extracted_track_features = extract_audio_features(track_feat)
-            key = extracted_track_features['key'] + (extracted_track_features['mode'] * 12)
-            if key_counts[key] < required_per_key:
-                key_counts[key] += 1
-                if not track_list_complete:
-                    _track_list.add_track_id(extracted_track_features['id'])
-                store_extracted_features(output_dir, extracted_track_features)
-                total += 1
-            _track_list.dump(output_dir)
-            if finished():
+        return all(key_counts[key] >= required_per_key for key in range(24)) or total >= n
+
+    def next_batch():
+        track_ids = get_n_track_ids(track_id_gen, 100, listed.__contains__)
+        listed.update(track_ids)
+        return track_ids, n_track_features(track_ids, client)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        batch = executor.submit(next_batch)
+        while not finished():
+            track_ids, track_feats = batch.result()
+            if len(track_ids) == 0:
                 break
-        perc = 100 * (total / n)
-        spinner.start(f'Listing tracks ({perc:.2f}%)')
+            # Request the next batch while this one is being stored
+            batch = executor.submit(next_batch)
+            stored = []
+            for track_feat in track_feats:
+                if track_feat is None:
+                    continue
+                extracted_track_features = extract_audio_features(track_feat)
+                key = get_key_index(extracted_track_features)
+                if key_counts[key] < required_per_key:
+                    key_counts[key] += 1
+                    store_extracted_features(output_dir, extracted_track_features, manifest)
+                    stored.append((extracted_track_features['id'], key))
+                    total += 1
+                    if finished():
+                        break
+            # Checkpoint by appending, rather than dumping the whole track list
+            manifest.commit()
+            append_features_log(output_dir, stored)
+            if not track_list_complete:
+                for track_id, _ in stored:
+                    _track_list.add_track_id(track_id)
+                _track_list.checkpoint(output_dir, [track_id for track_id, _ in stored])
+            perc = 100 * (total / n)
+            spinner.start(f'Listing tracks ({perc:.2f}%)')
+    manifest.close()
     spinner.stop()
     _track_list.dump(output_dir)
     if list_dir:
         _track_list.dump(list_dir)
 
 
-def fetch(output_dir):
+def index(mpl_data_path, index_dir, workers=4):
+    spinner = Halo('Indexing track ids', spinner='dots')
+    spinner.start()
+
+    def progress(n, n_files):
+        spinner.start(f'Indexing track ids ({100 * n / n_files:.2f}%)')
+    track_ids, counts = write_index(mpl_data_path, index_dir, workers, progress)
+    spinner.stop()
+    print(f'indexed {len(track_ids)} distinct tracks, occurring {counts.sum()} times in playlists')
+
+
+def fetch(output_dir, concurrency=8, rate=20.0, client=None):
     spinner = Halo('Fetching tracks', spinner='dots')
     spinner.start()
     _track_list = TrackList.load_from_dir(output_dir)
-    track_ids = get_missing(output_dir, AUDIO_ANALYSIS)
+    manifest = Manifest(output_dir)
+    track_ids = manifest.get_missing(AUDIO_ANALYSIS)
     if not exists(get_data_dir(output_dir, AUDIO_ANALYSIS)):
         makedirs(get_data_dir(output_dir, AUDIO_ANALYSIS))
-    track_analyses = n_track_analyses_generator(track_ids)
+    track_analyses = n_track_analyses_generator(track_ids, concurrency, rate, client)
     count = 0
     for track_analysis in track_analyses:
         if 'track_not_found' in track_analysis:
@@ -203,27 +289,23 @@ def fetch(output_dir):
         count += 1
         spinner.start(f'Fetching tracks ({count / _track_list.get_desired_tracks_amount():.2f}%)')
         extracted = extract_track_analysis(track_analysis)
-        store_extracted_analysis(output_dir, extracted)
+        store_extracted_analysis(output_dir, extracted, manifest)
+        # An interrupted fetch only fetches the uncommitted tracks again
+        if count % 100 == 0:
+            manifest.commit()
+    manifest.close()
     spinner.stop()
     _track_list.dump(output_dir)
 
 
 def get_missing(output_dir, data_type):
-    _track_list = TrackList.load_from_dir(output_dir)
-    return [
-        track_id
-        for track_id in _track_list.get_track_ids()
-        if not have_datapoint(output_dir, data_type, track_id)
-    ]
+    with Manifest(output_dir) as manifest:
+        return manifest.get_missing(data_type)
 
 
 def get_obsolete(output_dir, data_type):
-    _track_list = TrackList.load_from_dir(output_dir)
-    return [
-        str(track_file.name).split('.')[0]
-        for track_file in Path(get_data_dir(output_dir, data_type)).glob('*.pickle')
-        if not _track_list.have_track_id(str(track_file.name).split('.')[0])
-    ]
+    with Manifest(output_dir) as manifest:
+        return manifest.get_obsolete(data_type)
 
 
 def missing(output_dir, data_type, absolute):
@@ -249,22 +331,60 @@ def obsolete(output_dir, data_type, absolute):
 
 
 def check(output_dir):
-    for data_type in [AUDIO_ANALYSIS, AUDIO_FEATURES]:
-        missing_ids = get_missing(output_dir, data_type)
-        if len(missing_ids) == 0:
-            print(f"Everything is fine for {data_type}")
-        else:
-            print(f'missing {data_type} for {len(missing_ids)} tracks')
+    with Manifest(output_dir) as manifest:
+        for data_type in [AUDIO_ANALYSIS, AUDIO_FEATURES]:
+            missing_ids = manifest.get_missing(data_type)
+            if len(missing_ids) == 0:
+                print(f"Everything is fine for {data_type}")
+            else:
+                print(f'missing {data_type} for {len(missing_ids)} tracks')
 
 
 def count(output_dir):
-    track_list = TrackList.load_from_dir(output_dir)
-    N = len(track_list.track_ids)
-    print(f'expecting {N} tracks')
-    N_feat = count_data_points(output_dir, AUDIO_FEATURES)
-    print(f'found {N_feat} features objects')
-    N_ana = count_data_points(output_dir, AUDIO_ANALYSIS)
-    print(f'found {N_ana} analysis objects')
+    with Manifest(output_dir) as manifest:
+        N = manifest.count_tracks()
+        print(f'expecting {N} tracks')
+        N_feat = manifest.count(AUDIO_FEATURES)
+        print(f'found {N_feat} features objects')
+        N_ana = manifest.count(AUDIO_ANALYSIS)
+        print(f'found {N_ana} analysis objects')
+
+
+def reindex(output_dir):
+    spinner = Halo('Indexing stored data points', spinner='dots')
+    spinner.start()
+    with Manifest(output_dir) as manifest:
+        counts = manifest.reindex()
+    spinner.stop()
+    print(f'indexed {counts[AUDIO_FEATURES]} features objects and {counts[AUDIO_ANALYSIS]} analysis objects')
+
+
+def compact(output_dir, quantize=False):
+    spinner = Halo('Compacting tracks', spinner='dots')
+    spinner.start()
+    track_ids = TrackList.load_from_dir(output_dir).get_track_ids()
+
+    def progress(n):
+        if n % 1000 == 0:
+            spinner.start(f'Compacting tracks ({100 * n / len(track_ids):.2f}%)')
+    skipped = write_store(output_dir, track_ids, partial(load_analysis, output_dir), progress, quantize)
+    spinner.stop()
+    print(f'packed {len(track_ids) - len(skipped)} analysis objects '
+          f'({PackedStore.open(output_dir).nbytes / (1 << 20):.1f} MB)')
+    if len(skipped) > 0:
+        print(f'missing {AUDIO_ANALYSIS} for {len(skipped)} tracks, these were left out')
+
+
+def features(output_dir):
+    if not have_store(output_dir):
+        print(f'there is no packed store in {output_dir}, run compact first')
+        return
+    spinner = Halo('Computing derived features', spinner='dots')
+    spinner.start()
+    store = PackedStore.open(output_dir)
+    write_features(store, get_store_dir(output_dir))
+    spinner.stop()
+    print(f'computed {", ".join(store.features)} for {len(store)} tracks')
 
 
 if __name__ == '__main__':
@@ -281,9 +401,12 @@ if __name__ == '__main__':
                       f'({output_dir}). Either provide the path to a track_list.pickle with --use-list or make '
                       f'sure that {output_dir} is empty')
                 exit()
-        list_tracks(args.mpl_dir, args.output_dir, args.N, args.list_dir, track_list)
+        list_tracks(args.mpl_dir, args.output_dir, args.N, args.list_dir, track_list, args.index_dir, args.sample,
+                    args.seed)
+    elif args.command == 'index':
+        index(args.mpl_dir, args.index_dir, args.workers)
     elif args.command == 'fetch':
-        fetch(args.output_dir)
+        fetch(args.output_dir, args.concurrency, args.rate)
     elif args.command == 'check':
         check(args.output_dir)
     elif args.command == 'count':
@@ -292,3 +415,9 @@ if __name__ == '__main__':
         obsolete(args.output_dir, args.data_type, args.absolute)
     elif args.command == 'missing':
         missing(args.output_dir, args.data_type, args.absolute)
+    elif args.command == 'reindex':
+        reindex(args.output_dir)
+    elif args.command == 'compact':
+        compact(args.output_dir, args.quantize_chroma)
+    elif args.command == 'features':
+        features(args.output_dir)
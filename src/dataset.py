@@ -0,0 +1,76 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Dataset:
+    """
+    A lazily loaded set of tracks that can be used in place of a dict of analyses. Iterating over items() loads the
+    tracks in a thread pool, reading at most `prefetch` tracks ahead of the consumer. Loaded tracks are kept in an
+    LRU cache of at most `cache_size` tracks, so memory use does not grow with the size of the dataset.
+    """
+    def __init__(self, loader, track_ids, workers=4, prefetch=64, cache_size=1024):
+        self.loader = loader
+        self.track_ids = list(track_ids)
+        self.workers = workers
+        self.prefetch = max(prefetch, 1)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def __iter__(self):
+        return iter(self.track_ids)
+
+    def __getitem__(self, track_id):
+        if track_id in self.cache:
+            self.cache.move_to_end(track_id)
+            return self.cache[track_id]
+        analysis = self.loader(track_id)
+        self._cache(track_id, analysis)
+        return analysis
+
+    def _cache(self, track_id, analysis):
+        if self.cache_size <= 0:
+            return
+        self.cache[track_id] = analysis
+        self.cache.move_to_end(track_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def keys(self):
+        return list(self.track_ids)
+
+    def values(self):
+        for _, analysis in self.items():
+            yield analysis
+
+    def items(self):
+        if self.workers <= 1:
+            for track_id in self.track_ids:
+                yield track_id, self[track_id]
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            ids = iter(self.track_ids)
+
+            def submit_next():
+                track_id = next(ids, None)
+                if track_id is None:
+                    return
+                if track_id in self.cache:
+                    pending.append((track_id, None))
+                else:
+                    pending.append((track_id, executor.submit(self.loader, track_id)))
+
+            for _ in range(self.prefetch):
+                submit_next()
+            while pending:
+                track_id, future = pending.popleft()
+                submit_next()
+                if future is None:
+                    yield track_id, self[track_id]
+                    continue
+                analysis = future.result()
+                self._cache(track_id, analysis)
+                yield track_id, analysis
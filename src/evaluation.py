@@ -0,0 +1,91 @@
+from csv import writer
+from os import makedirs
+from os.path import join
+
+import numpy as np
+
+key_nums = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+modes = ["Minor", "Major"]
+key_names = np.array(["%s %s" % (key_nums[key % 12], modes[key // 12]) for key in range(24)])
+
+
+def get_confusion_matrix(estimates, labels):
+    ''' (24 x 24) counts of every (estimated key, label key) pair, keys numbered mode * 12 + key. '''
+    return np.bincount(np.asarray(estimates) * 24 + np.asarray(labels), minlength=24 * 24).reshape(24, 24)
+
+
+def get_error(confusion_matrix):
+    return 1 - np.trace(confusion_matrix) / max(confusion_matrix.sum(), 1)
+
+
+def get_error_rates(confusion_matrix):
+    '''
+    Error rates per label key and per label mode, nan for keys and modes without tracks. wrong_mode is the fraction
+    of tracks of which the mode was estimated wrong, whatever the key.
+    '''
+    tracks = confusion_matrix.sum(axis=0)
+    correct = np.diagonal(confusion_matrix)
+    mode_tracks = tracks.reshape(2, 12).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'tracks': tracks,
+            'key': 1 - correct / tracks,
+            'mode_tracks': mode_tracks,
+            'mode': 1 - correct.reshape(2, 12).sum(axis=1) / mode_tracks,
+            'wrong_mode': (confusion_matrix[:12, 12:].sum() + confusion_matrix[12:, :12].sum()) /
+                          max(tracks.sum(), 1),
+        }
+
+
+def get_error_rate_table(error_rates):
+    rows = [[key_names[key], error_rates['tracks'][key], 100 * error_rates['key'][key]] for key in range(24)]
+    rows += [["All " + modes[mode], error_rates['mode_tracks'][mode], 100 * error_rates['mode'][mode]]
+             for mode in range(2)]
+    return rows
+
+
+error_rate_headers = ["Label key", "Tracks", "Error (%)"]
+
+
+class ResultsWriter:
+    """
+    Writes the estimate of every test track as it is made, rather than keeping a table of them in memory. A path
+    ending in .csv gets a CSV file of track ids and key names. Any other path gets a directory of .npy columns
+    (track_ids, labels, estimates) of n_tracks rows, which are memory-mapped while writing.
+    """
+    def __init__(self, path, n_tracks):
+        self.csv = path.endswith('.csv')
+        self.n = 0
+        if self.csv:
+            self.file = open(path, 'w', newline='')
+            self.writer = writer(self.file)
+            self.writer.writerow(["track_id", "label", "estimate"])
+        else:
+            makedirs(path, exist_ok=True)
+            self.columns = {
+                name: np.lib.format.open_memmap(join(path, name + '.npy'), mode='w+', dtype=dtype, shape=(n_tracks,))
+                for name, dtype in [('track_ids', 'S22'), ('labels', np.int8), ('estimates', np.int8)]
+            }
+
+    def write(self, track_ids, labels, estimates):
+        if self.csv:
+            self.writer.writerows(zip(track_ids, key_names[labels], key_names[estimates]))
+        else:
+            batch = slice(self.n, self.n + len(track_ids))
+            self.columns['track_ids'][batch] = track_ids
+            self.columns['labels'][batch] = labels
+            self.columns['estimates'][batch] = estimates
+        self.n += len(track_ids)
+
+    def close(self):
+        if self.csv:
+            self.file.close()
+        else:
+            for column in self.columns.values():
+                column.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
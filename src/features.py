@@ -0,0 +1,35 @@
+"""
+Derived features of a track that the models would otherwise compute on every run. They are computed once, when the
+tracks are packed into a store (see store.py), and saved next to its arrays in files named after the feature and the
+version of its function. Bump the version when a function changes: stores with another version are ignored, and the
+models compute the feature themselves until the store is compacted again or `data.py features` is run.
+"""
+
+from os.path import join
+
+import numpy as np
+
+FEATURE_VERSIONS = {
+    'chroma_sums': 1,
+}
+
+
+def get_feature_path(store_dir, name) -> str:
+    return join(store_dir, f'{name}.v{FEATURE_VERSIONS[name]}.npy')
+
+
+def get_chroma_sums(pitches, duration):
+    # Running sums of the duration-weighted chroma vectors and of the durations, as (segments x 13). They are summed in
+    # float64 and stored as float32. The weighted average chroma of the first n segments, the naive model's input, is
+    # sums[n - 1, :12] / sums[n - 1, 12].
+    weighted = np.empty((len(pitches), 13))
+    weighted[:, :12] = pitches * np.asarray(duration, dtype=float)[:, None]
+    weighted[:, 12] = duration
+    return np.cumsum(weighted, axis=0)
+
+
+def get_mean_chroma(sums, n):
+    ''' The weighted average chroma of the first n segments, from the chroma sums of a track. None without any. '''
+    if n == 0 or sums[n - 1, 12] <= 0:
+        return None
+    return sums[n - 1, :12].astype(float) / float(sums[n - 1, 12])
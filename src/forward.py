@@ -0,0 +1,249 @@
+import numpy as np
+from scipy.special import logsumexp
+
+# rotation_index[i] maps the chroma of a sequence onto key i, i.e. seq[:, rotation_index[i]] == np.roll(seq, -i, axis=1)
+rotation_index = (np.arange(12)[None, :] + np.arange(12)[:, None]) % 12
+
+
+def rotate(seq):
+    ''' All 12 chroma rotations of a (segments x 12) sequence, as a (12 x segments x 12) array.
+    Scoring rotation i with a base model equals scoring seq with the base model transposed to key i.
+    '''
+    return np.moveaxis(seq[:, rotation_index], 1, 0)
+
+
+def log_forward(log_startprob, log_transmat, framelogprob, lengths=None):
+    ''' Forward algorithm, returning log-likelihoods. framelogprob has shape (..., segments, states) and any leading
+    axes are scored at once; the result has shape (...). Runs in scaled probability space, so every step is a single
+    matrix product rather than a logsumexp. For padded sequences, lengths (broadcastable to the leading axes) gives
+    the amount of segments to score. Runs in the precision of framelogprob, only the final sums are float64.
+    '''
+    batch_shape = framelogprob.shape[:-2]
+    n_segments, n_states = framelogprob.shape[-2:]
+    # Time-major, with all leading axes flattened into one
+    framelogprob = np.moveaxis(framelogprob.reshape(-1, n_segments, n_states), 1, 0)
+    dtype = framelogprob.dtype
+    frame_max = framelogprob.max(axis=-1, keepdims=True)
+    frameprob = np.exp(framelogprob - frame_max)
+    transmat = np.exp(log_transmat).astype(dtype)
+    alpha = np.exp(log_startprob).astype(dtype)
+    scale = np.empty(framelogprob.shape[:-1], dtype=dtype)
+    if lengths is not None:
+        lengths = np.broadcast_to(lengths, batch_shape).reshape(-1)
+    for t in range(n_segments):
+        step = (alpha if t == 0 else alpha @ transmat) * frameprob[t]
+        # Steps past the end of a sequence keep its alpha, a sequence without segments keeps the start probabilities
+        alpha = step if lengths is None else np.where((t < lengths)[:, None], step, alpha)
+        scale[t] = alpha.sum(axis=-1)
+        alpha /= scale[t, :, None]
+    frame_max = frame_max[..., 0]
+    if lengths is not None:
+        # Padded steps leave alpha as is and have a scale of 1 already
+        frame_max = np.where(np.arange(n_segments)[:, None] < lengths, frame_max, 0)
+    with np.errstate(divide='ignore'):
+        log_likelihood = np.log(scale).sum(axis=0, dtype=np.float64) + frame_max.sum(axis=0, dtype=np.float64)
+    return log_likelihood.reshape(batch_shape)
+
+
+def score_rotations(model, seq):
+    ''' Log-likelihood of the 12 transpositions of an hmmlearn model, computed on the rotated input. '''
+    rotations = rotate(seq)
+    framelogprob = model._compute_log_likelihood(rotations.reshape(-1, 12))
+    framelogprob = framelogprob.reshape(12, len(seq), -1)
+    with np.errstate(divide='ignore'):
+        return log_forward(np.log(model.startprob_), np.log(model.transmat_), framelogprob)
+
+
+def check_lengths(lengths, index):
+    # The forward algorithm has nothing to score for a sequence without segments
+    empty = index[lengths[index] == 0]
+    if len(empty) > 0:
+        raise ValueError('sequences %s have no segments' % empty.tolist())
+
+
+class BatchScorer:
+    ''' Scores many sequences against the 12 transpositions of a Gaussian (mixture) HMM with full covariances.
+    The precisions and log-determinants of every state are computed once, with the 12 chroma rotations folded into
+    the precisions, so the emissions of all keys are computed on the unrotated input.
+    Sequences are scored in buckets of similar length, so padding stays small and every forward step covers a whole
+    bucket. With dtype float32, the emissions and the forward algorithm run in single precision.
+    '''
+    def __init__(self, model, max_frames=20000, max_elements=1 << 22, dtype=np.float64):
+        self.max_frames = max_frames
+        self.max_elements = max_elements
+        self.dtype = np.dtype(dtype)
+        with np.errstate(divide='ignore'):
+            self.log_startprob = np.log(model.startprob_)
+            self.log_transmat = np.log(model.transmat_)
+        means = np.asarray(model.means_, dtype=float)
+        covars = np.asarray(model.covars_, dtype=float)
+        if means.ndim == 2:
+            # A GaussianHMM is a mixture with a single component
+            means = means[:, None]
+            covars = covars[:, None]
+            log_weights = np.zeros(means.shape[:2])
+        else:
+            with np.errstate(divide='ignore'):
+                log_weights = np.log(model.weights_)
+        n_states, n_mix, n_features = means.shape
+        cholesky = np.linalg.cholesky(covars)
+        log_det = 2 * np.log(np.diagonal(cholesky, axis1=-2, axis2=-1)).sum(axis=-1)
+        precision = np.linalg.inv(covars)
+        weighted_means = np.einsum('kmij,kmj->kmi', precision, means)
+        # The Mahalanobis distance expands to x'Px - 2 m'Px + m'Pm. With the 12 chroma rotations folded into the
+        # precisions, all keys and states are two matrix products on the unrotated input: one on the upper triangle
+        # of the outer product x x' and one on x itself.
+        self.triu = np.triu_indices(n_features)
+        quadratic = np.zeros((n_features, n_features, 12, n_states, n_mix))
+        linear = np.zeros((n_features, 12, n_states, n_mix))
+        for r in range(12):
+            index = rotation_index[r]
+            quadratic[index[:, None], index[None, :], r] = np.moveaxis(precision, (0, 1), (2, 3))
+            linear[index, r] = np.moveaxis(weighted_means, -1, 0)
+        quadratic = quadratic + np.swapaxes(quadratic, 0, 1) * (1 - np.eye(n_features))[..., None, None, None]
+        self.quadratic = quadratic[self.triu].reshape(len(self.triu[0]), -1).astype(self.dtype)
+        self.linear = (-2 * linear.reshape(n_features, -1)).astype(self.dtype)
+        self.constant = np.einsum('kmi,kmi->km', weighted_means, means).astype(self.dtype)
+        self.log_norm = (-.5 * (n_features * np.log(2 * np.pi) + log_det) + log_weights).astype(self.dtype)
+
+    def framelogprob(self, x, keys=None):
+        ''' Emission log-likelihoods of x (..., 12) for every key and state, with shape (..., 12, states). With keys, only
+        the emissions of those keys are computed, with shape (..., len(keys), states).
+        '''
+        n_states, n_mix = self.log_norm.shape
+        quadratic, linear = self.quadratic, self.linear
+        n_keys = 12
+        if keys is not None:
+            n_keys = len(keys)
+            quadratic = quadratic.reshape(len(quadratic), 12, -1)[:, keys].reshape(len(quadratic), -1)
+            linear = linear.reshape(len(linear), 12, -1)[:, keys].reshape(len(linear), -1)
+        rows = x.reshape(-1, 12).astype(self.dtype, copy=False)
+        result = np.empty((len(rows), n_keys, n_states), dtype=self.dtype)
+        chunk = max(self.max_elements // quadratic.shape[1], 1)
+        for i in range(0, len(rows), chunk):
+            block = rows[i:i + chunk]
+            outer = block[:, self.triu[0]] * block[:, self.triu[1]]
+            distance = (outer @ quadratic + block @ linear).reshape(-1, n_keys, n_states, n_mix)
+            component_logprob = self.log_norm - .5 * (distance + self.constant)
+            if n_mix == 1:
+                result[i:i + chunk] = component_logprob[..., 0]
+            else:
+                result[i:i + chunk] = logsumexp(component_logprob, axis=-1)
+        return result.reshape(x.shape[:-1] + (n_keys, n_states))
+
+    def buckets(self, lengths):
+        order = np.argsort(lengths, kind='stable')
+        bucket = []
+        for i in order:
+            if bucket and (len(bucket) + 1) * max(lengths[i], 1) > self.max_frames:
+                yield bucket
+                bucket = []
+            bucket.append(i)
+        if bucket:
+            yield bucket
+
+    def score(self, seqs):
+        ''' Log-likelihoods of a list of (segments x 12) sequences for the 12 keys, with shape (sequences x 12). '''
+        lengths = np.array([len(seq) for seq in seqs], dtype=int)
+        check_lengths(lengths, np.arange(len(seqs)))
+        scores = np.empty((len(seqs), 12))
+        for bucket in self.buckets(lengths):
+            bucket_lengths = lengths[bucket]
+            padded = self.pad([seqs[i] for i in bucket], bucket_lengths)
+            # (sequences x keys x segments x states)
+            framelogprob = np.moveaxis(self.framelogprob(padded), 2, 1)
+            scores[bucket] = log_forward(self.log_startprob, self.log_transmat, framelogprob,
+                                         bucket_lengths[:, None])
+        return scores
+
+    def score_pairs(self, seqs, seq_index, keys):
+        ''' Log-likelihoods of only the given (sequence, key) pairs, with shape (pairs). The forward algorithm only runs
+        on the pairs, so its cost grows with the amount of pairs rather than with 12 keys per sequence.
+        '''
+        lengths = np.array([len(seq) for seq in seqs], dtype=int)
+        scores = np.empty(len(seq_index))
+        used = np.unique(seq_index)
+        check_lengths(lengths, used)
+        position = np.empty(len(seqs), dtype=int)
+        n_states = self.log_norm.shape[0]
+        for bucket in self.buckets(lengths[used]):
+            bucket = used[bucket]
+            position[bucket] = np.arange(len(bucket))
+            padded = self.pad([seqs[i] for i in bucket], lengths[bucket])
+            pairs = np.flatnonzero(np.isin(seq_index, bucket))
+            pair_keys = keys[pairs]
+            bucket_keys, key_position = np.unique(pair_keys, return_inverse=True)
+            # Emissions of a single key are a thin matrix product, about 4 times the cost per (sequence, key) of the
+            # emissions of several keys at once. Sparse buckets compute them per pair, dense buckets for all of their
+            # sequences and keys.
+            if 4 * len(pairs) < len(bucket) * len(bucket_keys):
+                # (pairs x segments x states), filled one key at a time
+                framelogprob = np.empty((len(pairs), padded.shape[1], n_states), dtype=self.dtype)
+                for j, key in enumerate(bucket_keys):
+                    key_pairs = key_position == j
+                    framelogprob[key_pairs] = self.framelogprob(padded[position[seq_index[pairs[key_pairs]]]],
+                                                                keys=[key])[:, :, 0]
+            else:
+                # (sequences x segments x keys x states), gathered into (pairs x segments x states)
+                framelogprob = self.framelogprob(padded, bucket_keys)[position[seq_index[pairs]], :, key_position]
+            scores[pairs] = log_forward(self.log_startprob, self.log_transmat, framelogprob,
+                                        lengths[seq_index[pairs]])
+        return scores
+
+    def pad(self, seqs, lengths):
+        padded = np.zeros((len(seqs), max(lengths.max(), 1), 12), dtype=self.dtype)
+        for j, seq in enumerate(seqs):
+            padded[j, :lengths[j]] = seq
+        return padded
+
+
+class StreamingPredictor:
+    ''' Predicts the key of a track from its segments as they arrive. The scaled forward variables of all 12 keys of
+    both modes are carried from one call of add() to the next, so every segment is only scored once. Once the
+    log-likelihood of the best key leads the second best by margin, the prediction is final and later segments are
+    ignored. segments_used then tells how many segments the prediction took.
+    '''
+    def __init__(self, scorers, margin=10.0, mode=None):
+        self.scorers = scorers
+        self.margin = margin
+        # Only the keys of the given mode are scored
+        self.base_modes = [0, 1] if mode is None else [mode]
+        self.startprob = [np.exp(scorer.log_startprob) for scorer in scorers]
+        self.transmat = [np.exp(scorer.log_transmat) for scorer in scorers]
+        self.alpha = [None, None]
+        self.log_likelihood = np.full(24, -np.inf)
+        self.log_likelihood[np.concatenate([np.arange(12) + 12 * base_mode for base_mode in self.base_modes])] = 0
+        self.segments_used = 0
+        self.done = False
+
+    def add(self, pitches):
+        ''' Scores the next (segments x 12) chroma vectors. Returns the key once the margin is reached, else None. '''
+        if self.done:
+            return self.estimate()
+        pitches = np.asarray(pitches).reshape(-1, 12)
+        frames = {base_mode: self.scorers[base_mode].framelogprob(pitches) for base_mode in self.base_modes}
+        for t in range(len(pitches)):
+            for base_mode in self.base_modes:
+                framelogprob = frames[base_mode][t]
+                frame_max = framelogprob.max(axis=-1)
+                frameprob = np.exp(framelogprob - frame_max[:, None])
+                alpha = self.alpha[base_mode]
+                alpha = self.startprob[base_mode] * frameprob if alpha is None else \
+                    (alpha @ self.transmat[base_mode]) * frameprob
+                scale = alpha.sum(axis=-1)
+                self.alpha[base_mode] = alpha / scale[:, None]
+                with np.errstate(divide='ignore'):
+                    self.log_likelihood[12 * base_mode:12 * (base_mode + 1)] += np.log(scale) + frame_max
+            self.segments_used += 1
+            if self.get_margin() >= self.margin:
+                self.done = True
+                return self.estimate()
+        return None
+
+    def get_margin(self):
+        best, second = np.sort(self.log_likelihood)[-2:][::-1]
+        return best - second if np.isfinite(second) else np.inf
+
+    def estimate(self):
+        ''' The best key so far, final once done. '''
+        return int(np.argmax(self.log_likelihood))
@@ -1,107 +1,372 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from os import close, makedirs, remove
+from os.path import exists
+from tempfile import mkstemp
+from time import perf_counter
+
 import numpy as np
 from hmmlearn import hmm
+from tabulate import tabulate
 import copy
 
+from forward import BatchScorer, StreamingPredictor, score_rotations
+
+modes = ["Minor", "Major"]
+
+
+def shareable(array):
+    # Disk-backed training matrices are reopened in the worker rather than pickled into it
+    if isinstance(array, np.memmap) and array.filename is not None:
+        array.flush()
+        return MemmapFile(array)
+    return array
+
+
+class MemmapFile:
+    def __init__(self, array):
+        self.filename = array.filename
+        self.dtype = array.dtype
+        self.shape = array.shape
+        self.offset = array.offset
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+
+class SequenceBuffer:
+    """
+    Collects the training sequences of one mode when their total length is not known beforehand: in memory, or appended
+    to a raw file in directory, which is memory-mapped when done.
+    """
+    def __init__(self, name, dtype, directory=None):
+        self.dtype = dtype
+        self.lengths = []
+        self.chunks = []
+        self.file = None
+        if directory is not None:
+            if not exists(directory):
+                makedirs(directory)
+            fd, self.path = mkstemp(prefix=f'{name}_sequences-', suffix='.raw', dir=directory)
+            self.file = open(fd, 'wb')
+
+    def append(self, seq):
+        self.lengths.append(len(seq))
+        if self.file is None:
+            self.chunks.append(np.asarray(seq, dtype=self.dtype))
+        else:
+            self.file.write(np.ascontiguousarray(seq, dtype=self.dtype).tobytes())
+
+    def finish(self):
+        # The sequences as one (segments x 12) array, and their lengths
+        lengths = np.array(self.lengths, dtype=int)
+        n_segments = int(lengths.sum())
+        if self.file is None:
+            return np.concatenate(self.chunks) if self.chunks else np.empty((0, 12), dtype=self.dtype), lengths
+        self.file.close()
+        if n_segments == 0:
+            remove(self.path)
+            return np.empty((0, 12), dtype=self.dtype), lengths
+        return np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(n_segments, 12)), lengths
+
+
+def fit_base_model(mixture, hidden_states, iterations, seed, sequences, sequence_lengths, verbose=False):
+    if isinstance(sequences, MemmapFile):
+        sequences = sequences.open()
+    if mixture:
+        model = hmm.GMMHMM(n_components=hidden_states, covariance_type="full", n_iter=iterations, n_mix=10, random_state=seed, verbose=verbose)
+    else:
+        model = hmm.GaussianHMM(n_components=hidden_states, covariance_type="full", n_iter=iterations, random_state=seed, verbose=verbose)
+    start = perf_counter()
+    model.fit(sequences, sequence_lengths)
+    seconds = perf_counter() - start
+    return model, {
+        'seed': seed,
+        'converged': bool(model.monitor_.converged),
+        'iterations': model.monitor_.iter,
+        'log_likelihood': float(model.monitor_.history[-1]) if len(model.monitor_.history) > 0 else -np.inf,
+        'seconds': seconds,
+        'seconds_per_iteration': seconds / max(model.monitor_.iter, 1),
+    }
+
 
 class HMM_model:
 
-    model   = None
-    mixture = False
+    model       = None
+    base_models = None
+    scorers     = None
+    training_stats = None
+    mixture     = False
 
-    def __init__(self, n_components=3, n_iter=100):
+    def __init__(self, n_components=3, n_iter=100, memmap_dir=None, engine='rolled', restarts=1, seed=0, workers=2,
+                 dtype=np.float64):
         self.n_components = n_components
         self.n_iter = n_iter
+        # Optionally build the training matrices in a disk-backed memmap, for when they don't fit in memory
+        self.memmap_dir = memmap_dir
+        # 'rolled' scores the 2 base models on the 12 chroma rotations of the input, 'copies' scores 24 transposed
+        # copies of the base models
+        self.engine = engine
+        # Every base model is fit from `restarts` random initialisations (seeded seed, seed + 1, ...), of which the one
+        # with the highest log-likelihood is kept. Fits run in a pool of `workers` processes.
+        self.restarts = restarts
+        self.seed = seed
+        self.workers = workers
+        # Precision of the training matrices and of batched scoring. hmmlearn keeps float32 training matrices as they
+        # are, but computes the emissions in its EM steps in the float64 of the model parameters.
+        self.dtype = np.dtype(dtype)
     
-    def train(self, training_data_dict: dict, verbose=False):
+    def train(self, training_data_dict: dict, verbose=False, profiler=None):
         if verbose:
             print("Formatting training data...")
-        minor_sequences, minor_sequence_lengths, major_sequences, major_sequence_lengths = self.format_training_data(training_data_dict)
+        with profiler.stage('format_training_data') if profiler is not None else nullcontext():
+            minor_sequences, minor_sequence_lengths, major_sequences, major_sequence_lengths = self.format_training_data(training_data_dict)
         if verbose:
             print("Done.")
-        self.model = self.train_model(minor_sequences, minor_sequence_lengths, major_sequences, major_sequence_lengths, hidden_states=self.n_components, iterations=self.n_iter, verbose=verbose)
+        try:
+            with profiler.stage('train_model') if profiler is not None else nullcontext():
+                self.base_models = self.train_model(minor_sequences, minor_sequence_lengths, major_sequences, major_sequence_lengths, hidden_states=self.n_components, iterations=self.n_iter, verbose=verbose)
+        finally:
+            self.release_sequences(minor_sequences, major_sequences)
+        self.set_base_models(self.base_models, verbose=verbose)
         return
+
+    def set_base_models(self, base_models, verbose=False):
+        self.base_models = base_models
+        self.scorers = None
+        if self.engine == 'copies':
+            self.model = self.transpose_models(verbose=verbose)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, **self.get_arrays())
+
+    def get_arrays(self):
+        # Only the parameter arrays of the base models are stored, not the hmmlearn objects
+        arrays = {'method': 'hmm', 'n_components': self.n_components, 'n_iter': self.n_iter, 'mixture': self.mixture}
+        for name, base_model in zip(['minor', 'major'], self.base_models):
+            arrays[name + '_startprob'] = base_model.startprob_
+            arrays[name + '_transmat'] = base_model.transmat_
+            arrays[name + '_means'] = base_model.means_
+            arrays[name + '_covars'] = base_model.covars_
+            if self.mixture:
+                arrays[name + '_weights'] = base_model.weights_
+        return arrays
+
+    def load(self, path):
+        with np.load(path) as arrays:
+            self.set_arrays(arrays)
+        return self
+
+    def set_arrays(self, arrays):
+        self.n_components = int(arrays['n_components'])
+        self.n_iter = int(arrays['n_iter'])
+        self.mixture = bool(arrays['mixture'])
+        base_models = []
+        for name in ['minor', 'major']:
+            if self.mixture:
+                base_model = hmm.GMMHMM(n_components=self.n_components, covariance_type="full",
+                                        n_iter=self.n_iter, n_mix=arrays[name + '_means'].shape[1])
+                base_model.weights_ = arrays[name + '_weights']
+            else:
+                base_model = hmm.GaussianHMM(n_components=self.n_components, covariance_type="full",
+                                             n_iter=self.n_iter)
+            base_model.n_features = arrays[name + '_means'].shape[-1]
+            base_model.startprob_ = arrays[name + '_startprob']
+            base_model.transmat_ = arrays[name + '_transmat']
+            base_model.means_ = arrays[name + '_means']
+            base_model.covars_ = arrays[name + '_covars']
+            base_models.append(base_model)
+        self.set_base_models(base_models)
     
     def predict(self, test_sample: dict, mode=False):
         seq = self.format_sequence(test_sample)
         if mode is False:
-            estimate = np.argmax([mdl.score(seq) for mdl in self.model])
+            estimate = np.argmax(np.concatenate([self.score_keys(seq, 0), self.score_keys(seq, 1)]))
         elif mode == 0:
-            estimate = np.argmax([mdl.score(seq) for mdl in self.model[:12]])
+            estimate = np.argmax(self.score_keys(seq, 0))
         else:
-            estimate = np.argmax([mdl.score(seq) for mdl in self.model[12:]]) + 12
+            estimate = np.argmax(self.score_keys(seq, 1)) + 12
         return estimate
 
-    
+    def predict_batch(self, test_samples: list, mode=None):
+        return np.argmax(self.score_batch(test_samples, mode), axis=1)
+
+    def score_batch(self, test_samples: list, mode=None):
+        # Log-likelihoods of every sample for the 24 keys, -inf for the keys outside a given mode.
+        # mode is None, a single mode for all samples, or an array with the mode of every sample
+        modes = np.full(len(test_samples), -1) if mode is None else np.broadcast_to(mode, len(test_samples))
+        seqs = [self.format_sequence(sample) for sample in test_samples]
+        scores = np.full((len(seqs), 24), -np.inf)
+        for base_mode in range(2):
+            idx = np.flatnonzero((modes == -1) | (modes == base_mode))
+            if len(idx) == 0:
+                continue
+            if self.engine == 'copies':
+                scores[idx, base_mode * 12:(base_mode + 1) * 12] = [self.score_keys(seqs[i], base_mode) for i in idx]
+            else:
+                scores[idx, base_mode * 12:(base_mode + 1) * 12] = self.get_scorers()[base_mode].score(
+                    [seqs[i] for i in idx])
+        return scores
+
+    def score_candidates(self, test_samples: list, candidates):
+        # Log-likelihoods of every sample for only its candidate keys, -inf for the others. candidates is a boolean
+        # (samples x 24) array. The rolled engine scores all (sample, key) pairs of a base model at once, so the cost
+        # grows with the amount of candidates rather than with 24 keys per sample.
+        seqs = [self.format_sequence(sample) for sample in test_samples]
+        scores = np.full((len(seqs), 24), -np.inf)
+        for base_mode in range(2):
+            idx, rotations = np.nonzero(candidates[:, base_mode * 12:(base_mode + 1) * 12])
+            if len(idx) == 0:
+                continue
+            if self.engine == 'copies':
+                scores[idx, base_mode * 12 + rotations] = [self.model[base_mode * 12 + rotation].score(seqs[i])
+                                                           for i, rotation in zip(idx, rotations)]
+            else:
+                scorer = self.get_scorers()[base_mode]
+                scores[idx, base_mode * 12 + rotations] = scorer.score_pairs(seqs, idx, rotations)
+        return scores
+
+    def stream(self, margin=10.0, mode=None):
+        # Incremental predictor that takes the segments of one track as they arrive, see StreamingPredictor
+        return StreamingPredictor(self.get_scorers(), margin, mode)
+
+    def get_scorers(self):
+        # Vectorised scorers for the minor and major base models, with the per-state factorisations precomputed
+        if self.scorers is None:
+            self.scorers = [BatchScorer(base_model, dtype=self.dtype) for base_model in self.base_models]
+        return self.scorers
+
+    def score_keys(self, seq, mode):
+        # Log-likelihood of seq for each of the 12 keys within mode
+        if self.engine == 'copies':
+            return np.array([mdl.score(seq) for mdl in self.model[mode * 12:(mode + 1) * 12]])
+        return score_rotations(self.base_models[mode], seq)
+
+    def check_engine(self, testing_data_dict: dict):
+        # Count the test samples for which the rolled engine and the transposed copies disagree
+        if self.model is None:
+            self.model = self.transpose_models()
+        engine = self.engine
+        mismatches = 0
+        for track_id, analysis in testing_data_dict.items():
+            self.engine = 'rolled'
+            rolled = self.predict(analysis)
+            self.engine = 'copies'
+            copies = self.predict(analysis)
+            if rolled != copies:
+                mismatches += 1
+        self.engine = engine
+        return mismatches
+
     def train_model(self, minor_sequences, minor_sequence_lengths, major_sequences, major_sequence_lengths, hidden_states, iterations, verbose=False):
 
-        # Train two base models for major and minor
-        if self.mixture:
-            model_minor = hmm.GMMHMM(n_components=hidden_states, covariance_type="full", n_iter=iterations, n_mix=10, verbose=verbose)
-            model_major = hmm.GMMHMM(n_components=hidden_states, covariance_type="full", n_iter=iterations, n_mix=10, verbose=verbose)
-        else:
-            model_minor = hmm.GaussianHMM(n_components=hidden_states, covariance_type="full", n_iter=iterations, verbose=verbose)
-            model_major = hmm.GaussianHMM(n_components=hidden_states, covariance_type="full", n_iter=iterations, verbose=verbose)
-        
-        if verbose:
-            print("Training minor model...")
-        model_minor.fit(minor_sequences, minor_sequence_lengths)
+        # Train two base models for major and minor, each from self.restarts random initialisations
+        sequences = [
+            (minor_sequences, minor_sequence_lengths),
+            (major_sequences, major_sequence_lengths),
+        ]
+        jobs = [(mode, restart) for mode in range(2) for restart in range(self.restarts)]
         if verbose:
-            print("Trained minor model. Converged: %s" % str(model_minor.monitor_.converged))
-            print("Training major model...")
-        model_major.fit(major_sequences, major_sequence_lengths)
+            print("Training minor and major models (%d restart(s) each)..." % self.restarts)
+        if self.workers <= 1:
+            fits = [fit_base_model(self.mixture, hidden_states, iterations, self.seed + restart,
+                                   *sequences[mode], verbose=verbose)
+                    for mode, restart in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs))) as executor:
+                futures = [executor.submit(fit_base_model, self.mixture, hidden_states, iterations,
+                                           self.seed + restart, *map(shareable, sequences[mode]), verbose=verbose)
+                           for mode, restart in jobs]
+                fits = [future.result() for future in futures]
+
+        # Keep the restart with the highest log-likelihood for every mode
+        base_models = []
+        self.training_stats = []
+        for mode in range(2):
+            mode_fits = [(restart, fits[i]) for i, (job_mode, restart) in enumerate(jobs) if job_mode == mode]
+            best_restart, (best_model, _) = max(mode_fits, key=lambda fit: fit[1][1]['log_likelihood'])
+            base_models.append(best_model)
+            for restart, (_, stats) in mode_fits:
+                self.training_stats.append(dict(stats, mode=modes[mode], restart=restart,
+                                                selected=restart == best_restart))
         if verbose:
-            print("Trained major model. Converged: %s" % str(model_major.monitor_.converged))
+            print(tabulate([[stats['mode'], stats['restart'], stats['seed'], stats['converged'], stats['iterations'],
+                             stats['log_likelihood'], stats['seconds'], '*' if stats['selected'] else '']
+                            for stats in self.training_stats],
+                           headers=['Mode', 'Restart', 'Seed', 'Converged', 'Iterations', 'Log-likelihood',
+                                    'Seconds', 'Selected']))
             print("Done.")
+        return base_models
 
+    def transpose_models(self, verbose=False):
         # Transpose the base models to all other keys
         if verbose:
             print("Copying models...")
         models = []
-        for i in range(0, 12):
-            key_model = copy.deepcopy(model_minor)
-            if self.mixture:
-                key_model.means_ = np.roll(key_model.means_, i, axis=2)
-                key_model.covars_ = np.roll(np.roll(key_model.covars_, i, axis=2), i, axis=3)
-            else:
-                key_model.means_ = np.roll(key_model.means_, i, axis=1)
-                key_model.covars_ = np.roll(np.roll(key_model.covars_, i, axis=1), i, axis=2)
-            models.append(key_model)
-        for i in range(0, 12):
-            key_model = copy.deepcopy(model_major)
-            if self.mixture:
-                key_model.means_ = np.roll(key_model.means_, i, axis=2)
-                key_model.covars_ = np.roll(np.roll(key_model.covars_, i, axis=2), i, axis=3)
-            else:
-                key_model.means_ = np.roll(key_model.means_, i, axis=1)
-                key_model.covars_ = np.roll(np.roll(key_model.covars_, i, axis=1), i, axis=2)
-            models.append(key_model)
+        for base_model in self.base_models:
+            for i in range(0, 12):
+                key_model = copy.deepcopy(base_model)
+                if self.mixture:
+                    key_model.means_ = np.roll(key_model.means_, i, axis=2)
+                    key_model.covars_ = np.roll(np.roll(key_model.covars_, i, axis=2), i, axis=3)
+                else:
+                    key_model.means_ = np.roll(key_model.means_, i, axis=1)
+                    key_model.covars_ = np.roll(np.roll(key_model.covars_, i, axis=1), i, axis=2)
+                models.append(key_model)
         if verbose:
             print("Done")
         return models
 
     def format_training_data(self, training_data_dict: dict):
-        minor_sequences        = np.zeros((0,12))
-        minor_sequence_lengths = []
-        major_sequences        = np.zeros((0,12))
-        major_sequence_lengths = []
-        for track_id in training_data_dict:
-            analysis = training_data_dict[track_id]
-            
-            # Format sequence
-            seq = self.format_sequence(analysis)
-            seq = np.roll(seq, -analysis["key"]) # All sequences are transposed to the "base" key (C)
-            
-            # Add sequence to set of all sequences within mode
-            if analysis["mode"] == 1:
-                major_sequences = np.concatenate((major_sequences, seq))
-                major_sequence_lengths.append(seq.shape[0])
-            else:
-                minor_sequences = np.concatenate((minor_sequences, seq))
-                minor_sequence_lengths.append(seq.shape[0])
-
-        minor_sequence_lengths = np.array(minor_sequence_lengths)
-        major_sequence_lengths = np.array(major_sequence_lengths)
+        # Every track is loaded once. Store views know the amount of segments of their tracks up front, so the arrays
+        # are sized first and filled while loading; other datasets collect the sequences until the sizes are known.
+        if hasattr(training_data_dict, 'get_lengths'):
+            return self.fill_training_data(training_data_dict)
+        buffers = [SequenceBuffer(name, self.dtype, self.memmap_dir) for name in ['minor', 'major']]
+        for track_id, analysis in training_data_dict.items():
+            buffers[int(analysis["mode"] == 1)].append(self.transpose_sequence(analysis))
+        minor_sequences, minor_sequence_lengths = buffers[0].finish()
+        major_sequences, major_sequence_lengths = buffers[1].finish()
         return minor_sequences, minor_sequence_lengths, major_sequences, major_sequence_lengths
+
+    def fill_training_data(self, store_view):
+        is_major = store_view.get_modes() == 1
+        lengths = store_view.get_lengths()
+        minor_sequence_lengths = lengths[~is_major]
+        major_sequence_lengths = lengths[is_major]
+        sequences = [
+            self.allocate_sequences('minor', minor_sequence_lengths.sum()),
+            self.allocate_sequences('major', major_sequence_lengths.sum()),
+        ]
+        positions = [0, 0]
+        for track_id, analysis in store_view.items():
+            mode = int(analysis["mode"] == 1)
+            seq = self.transpose_sequence(analysis)
+            sequences[mode][positions[mode]:positions[mode] + len(seq)] = seq
+            positions[mode] += len(seq)
+        return sequences[0], minor_sequence_lengths, sequences[1], major_sequence_lengths
+
+    def transpose_sequence(self, analysis):
+        # All sequences are transposed to the "base" key (C), i.e. rolled by -key along the chroma axis
+        chroma = (np.arange(12) + analysis["key"]) % 12
+        return self.format_sequence(analysis)[:, chroma]
+
+    def allocate_sequences(self, name, n_segments):
+        if self.memmap_dir is None:
+            return np.empty((n_segments, 12), dtype=self.dtype)
+        if not exists(self.memmap_dir):
+            makedirs(self.memmap_dir)
+        # A file of its own for every call, as parallel folds and sweep jobs can share the memmap directory
+        fd, path = mkstemp(prefix=f'{name}_sequences-', suffix='.npy', dir=self.memmap_dir)
+        close(fd)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=(int(n_segments), 12))
+
+    def release_sequences(self, *sequences):
+        # Removes the files of disk-backed training matrices once the base models are fit
+        for seq in sequences:
+            if isinstance(seq, np.memmap) and seq.filename is not None and exists(seq.filename):
+                remove(seq.filename)
     
     def format_sequence(self, audio_analysis):
         return audio_analysis["pitches"]
\ No newline at end of file
@@ -1,13 +1,22 @@
 from argparse import ArgumentParser
 from tracklist import TrackList
 from data import load_analysis
+from dataset import Dataset
+from evaluation import ResultsWriter, error_rate_headers, get_confusion_matrix, get_error, get_error_rate_table, \
+    get_error_rates
+from process import window_analysis
+from model_cache import ModelCache
+from profiler import Profiler
+from store import PackedStore, Track, attach, have_store, pack_tracks
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from os import makedirs, replace
+from os.path import basename, dirname, join
+from time import perf_counter
 import numpy as np
 from tabulate import tabulate
 
-key_nums = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-modes = ["Minor", "Major"]
-
-def get_args():
+def get_args(argv=None):
     arg_parser = ArgumentParser()
     arg_parser.add_argument('--data-dir', default='dataset', type=str, help='''
         The directory where the track data is stored to use for the analysis.
@@ -22,7 +31,11 @@ def get_args():
         Optional filename of a CSV file to store the resulting confusion matrix
         ''')
     arg_parser.add_argument('--table', action='store_true', help='''
-        Whether or not to print a table of all the test samples and their classification
+        Whether or not to print the error rate of every key and mode, and the confusion matrix
+        ''')
+    arg_parser.add_argument('--results', default='', type=str, help='''
+        Optionally write the label and estimate of every test sample to this file while testing: a CSV file when it
+        ends in .csv, else a directory of .npy columns. Cross-validation folds get a split_<fold>- prefix.
         ''')
     arg_parser.add_argument('--verbose', action='store_true', help='''
         Verbose model training
@@ -30,12 +43,46 @@ def get_args():
     arg_parser.add_argument('--cross-validation', action='store_true', help='''
         Run N-fold cross-validation (N = <--test-split>)
         ''')
+    arg_parser.add_argument('--workers', default=1, type=int, help='''
+        Amount of processes to run cross-validation folds in. The data is loaded once and shared between them.
+        ''')
     arg_parser.add_argument('--dry', action='store_true', help='''
         Dry run: only test program execution - use only a couple training samples in total.
         ''')
     arg_parser.add_argument('--subset', default=10000, type=int, help='''
         Subset sample: only use a subset of training samples in total.
         ''')
+    arg_parser.add_argument('--load-workers', default=4, type=int, help='''
+        Amount of threads used to load tracks while the model is training or testing.
+        ''')
+    arg_parser.add_argument('--prefetch', default=64, type=int, help='''
+        Maximum amount of tracks to read ahead of the model.
+        ''')
+    arg_parser.add_argument('--cache-size', default=1024, type=int, help='''
+        Maximum amount of loaded tracks to keep in memory.
+        ''')
+    arg_parser.add_argument('--batch-size', default=1024, type=int, help='''
+        Amount of testing samples to classify at once.
+        ''')
+    arg_parser.add_argument('--model-cache', default='', type=str, help='''
+        Optional directory to cache trained models in, keyed by the track list, fold and hyperparameters.
+        ''')
+    arg_parser.add_argument('--model-cache-size', default=1024, type=int, help='''
+        Maximum size of the model cache in MB. The least recently used models are evicted first.
+        ''')
+    arg_parser.add_argument('--quantize-chroma', action='store_true', help='''
+        Keep the chroma vectors of the tracks loaded for cross-validation as uint8 rather than float32.
+        ''')
+    arg_parser.add_argument('--window-seconds', default=20, type=float, help='''
+        Only use the segments of the first N seconds of every track. Uses the whole track when 0.
+        ''')
+    arg_parser.add_argument('--save-model', default='', type=str, help='''
+        Save the trained model to this .npz file, e.g. to serve it with server.py.
+        ''')
+    arg_parser.add_argument('--profile', default='', type=str, help='''
+        Write the wall time and peak memory of every stage, the EM iterations and the prediction latencies to this
+        JSON file.
+        ''')
     arg_parser.add_argument('--n_components', default=3, type=int, help='''
         Amount of components ('hidden states') to use for HMM training.
         ''')
@@ -57,20 +104,69 @@ def get_args():
     hmm_sub_parser = sub_parsers.add_parser('hmm', help='''
         Test classification using the HMM method.
     ''')
-    hmm_sub_parser.add_argument('--mixture', action='store_true', help='''
+    add_hmm_arguments(hmm_sub_parser)
+
+    # Cascade method
+    cascade_sub_parser = sub_parsers.add_parser('cascade', help='''
+        Test classification using the HMM method on only the keys ranked highest by the naive method.
+    ''')
+    add_hmm_arguments(cascade_sub_parser)
+    cascade_sub_parser.add_argument('--top-k', default=3, type=int, help='''
+        Amount of keys with the highest naive correlation to score with the HMM.
+        ''')
+    cascade_sub_parser.add_argument('--cutoff', default=None, type=float, help='''
+        Keep the naive estimate, without any HMM scoring, when its correlation leads the second best key by at least
+        this much. Always uses the HMM when not given.
+        ''')
+    return arg_parser.parse_args(argv)
+
+
+def add_hmm_arguments(sub_parser):
+    sub_parser.add_argument('--mixture', action='store_true', help='''
         Use a Gaussian mixture model
         ''')
-    return arg_parser.parse_args()
+    sub_parser.add_argument('--memmap-dir', default=None, type=str, help='''
+        Build the training matrices as memory-mapped files in this directory, for training sets that don't fit in RAM.
+        ''')
+    sub_parser.add_argument('--restarts', default=1, type=int, help='''
+        Amount of randomly initialised fits per base model, the one with the highest log-likelihood is kept.
+        ''')
+    sub_parser.add_argument('--seed', default=0, type=int, help='''
+        Random seed of the first fit, restarts use the following seeds.
+        ''')
+    sub_parser.add_argument('--train-workers', default=2, type=int, help='''
+        Amount of processes to fit the minor and major models and their restarts in.
+        ''')
+    sub_parser.add_argument('--engine', default='rolled', choices=['rolled', 'copies'], help='''
+        Score the 24 keys by rolling the input through the 2 base models, or through 24 transposed model copies.
+        ''')
+    sub_parser.add_argument('--check-engine', action='store_true', help='''
+        Check that both engines give the same predictions on the testing data.
+        ''')
+    sub_parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'], help='''
+        Precision of the training matrices and of batched scoring. float32 halves their memory use.
+        ''')
+
+
+def load_track(data_dir, track_id, window_seconds=None) -> Track:
+    return Track.from_analysis(window_analysis(load_analysis(data_dir, track_id), window_seconds))
+
 
+def get_loader(data_dir, window_seconds=None):
+    # Prefer the packed store (see `data.py compact`), falling back to the pickles for tracks it doesn't contain
+    if not have_store(data_dir):
+        return lambda track_id: load_track(data_dir, track_id, window_seconds)
+    store = PackedStore.open(data_dir)
 
-def load_data_dict(data_dir, track_ids):
-    testing_data = {}
-    for track_id in track_ids:
-        analysis = load_analysis(data_dir, track_id)
-        testing_data[track_id] = analysis
-    return testing_data
+    def loader(track_id):
+        if store.have_track_id(track_id):
+            return store.load_analysis(track_id, window_seconds)
+        return load_track(data_dir, track_id, window_seconds)
+    return loader
 
-def collect_data(data_dir, test_split, test_split_index=0 , verbose=False, dry=False, subset=10000):
+
+def collect_data(data_dir, test_split, test_split_index=0 , verbose=False, dry=False, subset=10000, workers=4,
+                 prefetch=64, cache_size=1024, window_seconds=None):
     track_list = TrackList.load_from_dir(data_dir)
     all_tracks = track_list.get_track_ids()
     n = len(all_tracks)
@@ -79,20 +175,131 @@ def collect_data(data_dir, test_split, test_split_index=0 , verbose=False, dry=F
     chunks = np.array_split(np.arange(n), test_split)
     test_split =  chunks[test_split_index]
     train_split = np.concatenate(chunks[:test_split_index] + chunks[test_split_index+1:])
+    loader = get_loader(data_dir, window_seconds)
+    # Tracks are only loaded once the model iterates over them
+    training_data = Dataset(loader, np.array(all_tracks)[train_split], workers, prefetch, cache_size)
+    testing_data = Dataset(loader, np.array(all_tracks)[test_split], workers, prefetch, cache_size)
     if verbose:
-        print("Collecting training data...")
-    training_data = load_data_dict(data_dir, np.array(all_tracks)[train_split])
-    if verbose:
-        print("Collecting testing data...")
-    testing_data = load_data_dict(data_dir, np.array(all_tracks)[test_split])
-    if verbose:
-        print("Data collected.")
+        print("Data collected: %d training and %d testing tracks." % (len(training_data), len(testing_data)))
     return training_data, testing_data
 
 
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_shared_data(data_dir, dry=False, subset=10000, workers=4, prefetch=64, cache_size=1024, quantize=False,
+                     features=False):
+    '''
+    Loads the data for all folds once. Returns the store, the store rows of the tracks in track list order, a spec to
+    attach() to the store from other processes, and any shared memory blocks to clean up afterwards. Tracks are loaded
+    in full, the folds apply the time window. An in-memory store only gets the derived features with features, which
+    only the naive and cascade methods use.
+    '''
+    track_ids = TrackList.load_from_dir(data_dir).get_track_ids()
+    if dry:
+        track_ids = track_ids[:subset]
+    if have_store(data_dir):
+        store = PackedStore.open(data_dir)
+        if all(store.have_track_id(track_id) for track_id in track_ids):
+            # Memory-mapped, so the OS already shares it between processes
+            return store, np.array([store.index[track_id] for track_id in track_ids]), {'dir': data_dir}, []
+    store = pack_tracks(Dataset(get_loader(data_dir), track_ids, workers, prefetch, cache_size).items(), quantize,
+                        features)
+    blocks, spec = store.share(features)
+    return store, np.arange(len(track_ids)), spec, blocks
+
+
+def split_rows(rows, test_split, test_split_index):
+    chunks = np.array_split(rows, test_split)
+    return np.concatenate(chunks[:test_split_index] + chunks[test_split_index+1:]), chunks[test_split_index]
+
+
+shared_store = None
+
+def set_shared_store(store):
+    global shared_store
+    shared_store = store
+
+
+def attach_shared_store(spec):
+    set_shared_store(attach(spec))
+
+
+def run_fold(args, rows, test_split_index):
+    # Folds are views into the shared store, not copies of the data
+    train_rows, test_rows = split_rows(rows, args.test_split, test_split_index)
+    data = (shared_store.subset(train_rows, args.window_seconds),
+            shared_store.subset(test_rows, args.window_seconds))
+    return run_key_recognition(args, verbose=False, test_split_index=test_split_index, data=data)
+
+
+def run_profiled_fold(args, rows, test_split_index):
+    train_rows, test_rows = split_rows(rows, args.test_split, test_split_index)
+    data = (shared_store.subset(train_rows, args.window_seconds),
+            shared_store.subset(test_rows, args.window_seconds))
+    profiler = Profiler()
+    result = run_key_recognition(args, verbose=False, test_split_index=test_split_index, data=data, profiler=profiler)
+    return result, dict(profiler.report(), fold=test_split_index)
+
+
+def run_cross_validation(args, profiler=None):
+    with profiler.stage('load_shared_data') if profiler is not None else nullcontext():
+        store, rows, spec, blocks = load_shared_data(args.data_dir, dry=args.dry, subset=args.subset,
+            workers=args.load_workers, prefetch=args.prefetch, cache_size=args.cache_size,
+            quantize=args.quantize_chroma, features=args.method != 'hmm')
+    folds = list(range(args.test_split))
+    # With a profiler, every fold is profiled on its own and the fold reports are added to it
+    run = run_fold if profiler is None else run_profiled_fold
+    try:
+        with profiler.stage('folds') if profiler is not None else nullcontext():
+            if args.workers <= 1:
+                set_shared_store(store)
+                results = [run(args, rows, i) for i in folds]
+            else:
+                with ProcessPoolExecutor(max_workers=args.workers, initializer=attach_shared_store,
+                                         initargs=(spec,)) as executor:
+                    results = list(executor.map(run, [args] * len(folds), [rows] * len(folds), folds))
+        if profiler is None:
+            return results
+        profiler.stats['folds'] = [report for _, report in results]
+        return [result for result, _ in results]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def get_model_cache_key(args, test_split_index):
+    # Everything that determines the training data and the trained parameters
+    return ModelCache.key(
+        tracks=TrackList.load_from_dir(args.data_dir).hash(),
+        test_split=args.test_split,
+        test_split_index=test_split_index,
+        subset=args.subset if args.dry else None,
+        window_seconds=args.window_seconds,
+        quantize_chroma=args.quantize_chroma if args.cross_validation else None,
+        method=args.method,
+        n_components=args.n_components if args.method != 'naive' else None,
+        n_iter=args.n_iter if args.method != 'naive' else None,
+        mixture=args.mixture if args.method != 'naive' else None,
+        restarts=args.restarts if args.method != 'naive' else None,
+        seed=args.seed if args.method != 'naive' else None,
+        dtype=args.dtype if args.method != 'naive' else None,
+    )
+
 
 ''' MAIN PROGRAM '''
-def run_key_recognition(args, verbose=True, test_split_index=0):
+def run_key_recognition(args, verbose=True, test_split_index=0, data=None, profiler=None):
+    # Stages are always timed, it costs next to nothing
+    profiler = profiler if profiler is not None else Profiler()
 
     # Import selected model
     if args.method == 'naive':
@@ -101,60 +308,106 @@ def run_key_recognition(args, verbose=True, test_split_index=0):
         pass
     else:
         from hmm_model import HMM_model
-        model = HMM_model(n_components=args.n_components, n_iter=args.n_iter)
+        model = HMM_model(n_components=args.n_components, n_iter=args.n_iter, memmap_dir=args.memmap_dir,
+                          engine=args.engine, restarts=args.restarts, seed=args.seed, workers=args.train_workers,
+                          dtype=args.dtype)
         if args.mixture:
             model.mixture = True
+        if args.method == 'cascade':
+            from cascade_model import Cascade_model
+            model = Cascade_model(model, top_k=args.top_k, cutoff=args.cutoff)
         pass
     
-    # Collect data
-    training_data, testing_data = collect_data(args.data_dir, args.test_split, test_split_index=test_split_index, verbose=verbose, dry=args.dry, subset=args.subset)
+    # Collect data, unless it was already loaded for all folds at once
+    if data is None:
+        with profiler.stage('collect_data'):
+            training_data, testing_data = collect_data(args.data_dir, args.test_split,
+                test_split_index=test_split_index, verbose=verbose, dry=args.dry, subset=args.subset,
+                workers=args.load_workers, prefetch=args.prefetch, cache_size=args.cache_size,
+                window_seconds=args.window_seconds)
+    else:
+        training_data, testing_data = data
 
-    # Train model
+    # Train model, or load it from the model cache
     if args.method != 'naive' or not args.no_training:
-        model.train(training_data, verbose=verbose)
+        cache = None
+        if args.model_cache:
+            cache = ModelCache(args.model_cache, args.model_cache_size << 20)
+            cache_key = get_model_cache_key(args, test_split_index)
+        if cache is not None and cache.load(cache_key, model):
+            if verbose:
+                print("Loaded trained model from cache.")
+        else:
+            # Tracks are loaded lazily, so loading time is part of the first training stage
+            if args.method != 'naive':
+                model.train(training_data, verbose=verbose, profiler=profiler)
+                profiler.stats['training'] = model.training_stats
+            else:
+                with profiler.stage('train'):
+                    model.train(training_data, verbose=verbose)
+            if cache is not None:
+                cache.store(cache_key, model)
+        if args.save_model and not args.cross_validation:
+            # Written next to the file and then moved over it, so a server reloading it never sees half a model
+            if dirname(args.save_model):
+                makedirs(dirname(args.save_model), exist_ok=True)
+            model.save(args.save_model + '.tmp')
+            replace(args.save_model + '.tmp', args.save_model)
+
+    if args.method != 'naive' and args.check_engine:
+        with profiler.stage('check_engine'):
+            mismatches = (model.hmm_model if args.method == 'cascade' else model).check_engine(testing_data)
+        print("Engine check: %d of %d predictions differ" % (mismatches, len(testing_data)))
     
-    results_table = []
-    test_n = 0
-    errors = 0
-    conf_mat = np.zeros((24,24))
+    conf_mat = np.zeros((24, 24), dtype=int)
+    results = None
+    if args.results:
+        path = args.results
+        if args.cross_validation:
+            path = join(dirname(path), 'split_{}-{}'.format(test_split_index, basename(path)))
+        results = ResultsWriter(path, len(testing_data))
 
     # Try all the testing samples on the model
     if verbose:
         print("Testing model...")
-    for track_id in testing_data:
-        track_data = testing_data[track_id]
-        if args.give_mode:
-            estimation_key = model.predict(track_data, mode=track_data["mode"])
-        else:
-            estimation_key = model.predict(track_data)
-        
-        # Confusion matrix
-        conf_mat[estimation_key, track_data["mode"]*12 + track_data["key"]] += 1
+    with profiler.stage('predict'), results if results is not None else nullcontext():
+        for batch in batches(testing_data.items(), args.batch_size):
+            tracks = [track_data for _, track_data in batch]
+            labels = np.array([track_data["mode"] * 12 + track_data["key"] for track_data in tracks], dtype=int)
+            start = perf_counter()
+            if args.give_mode:
+                estimation_keys = model.predict_batch(tracks, mode=labels // 12)
+            else:
+                estimation_keys = model.predict_batch(tracks)
+            profiler.add_batch(len(tracks), perf_counter() - start)
 
-        # Count errors
-        test_n += 1
-        if not (track_data["key"] == estimation_key % 12 and track_data["mode"] == estimation_key // 12):
-            errors += 1
-        
-        # Report all test samples
-        results_table.append([track_id, 
-            "%s %s"% (key_nums[track_data["key"]], modes[track_data["mode"]]), 
-            "%s %s"% (key_nums[estimation_key % 12], modes[estimation_key // 12]),
-        ])
+            conf_mat += get_confusion_matrix(estimation_keys, labels)
+            if results is not None:
+                results.write([track_id for track_id, _ in batch], labels, estimation_keys)
     if verbose:
         print("Done.")
+    if args.method == 'cascade':
+        profiler.stats['cascade'] = dict(model.stats)
+        if verbose:
+            print("Cascade: skipped the HMM for %d of %d tracks, scored %.2f keys per track with it." % (
+                model.stats['skipped'], model.stats['tracks'], model.stats['hmm_keys'] / max(model.stats['tracks'], 1)))
+
+    return get_error(conf_mat), get_error_rates(conf_mat), conf_mat
 
-    return errors/test_n, results_table, conf_mat
+
+def print_error_rates(error_rates):
+    print(tabulate(get_error_rate_table(error_rates), headers=error_rate_headers, floatfmt='.2f'))
+    print("Wrong mode: %5.2f%%" % (100 * error_rates['wrong_mode']))
 
 if __name__ == '__main__':
     args = get_args()
+    profiler = Profiler() if args.profile else None
     if args.cross_validation:
         print(f"Running {args.test_split}-fold cross validation.")
-        for i in range(args.test_split):
-            error, results_table, confusion_matrix = run_key_recognition(args, verbose=False, test_split_index=i)
-        
+        fold_results = run_cross_validation(args, profiler)
+        for i, (error, error_rates, confusion_matrix) in enumerate(fold_results):
             if args.table:
-                print(tabulate(results_table, headers=["Song ID", "Label key", "Predicted key"]))
+                print_error_rates(error_rates)
                 print(confusion_matrix)
             
             print("Overall error: %5.2f%%" % (error*100))
@@ -162,14 +415,29 @@ if __name__ == '__main__':
             if args.csv is not False:
                 np.savetxt('split_{}-{}'.format(i, args.csv), confusion_matrix)
 
+        # Merge the folds into one report
+        confusion_matrix = np.sum([fold_conf_mat for _, _, fold_conf_mat in fold_results], axis=0)
+        errors = [error for error, _, _ in fold_results]
+        print(tabulate([[i, error * 100] for i, error in enumerate(errors)], headers=["Fold", "Error (%)"],
+                       floatfmt='.2f'))
+        if args.table:
+            print_error_rates(get_error_rates(confusion_matrix))
+            print(confusion_matrix)
+        print("Cross-validated error: %5.2f%% (std %.2f%%)" % (100 * get_error(confusion_matrix), 100 * np.std(errors)))
+        if args.csv is not False:
+            np.savetxt(args.csv, confusion_matrix)
+
     else:
-        error, results_table, confusion_matrix = run_key_recognition(args, verbose=args.verbose)
+        error, error_rates, confusion_matrix = run_key_recognition(args, verbose=args.verbose, profiler=profiler)
         
         if args.table:
-            print(tabulate(results_table, headers=["Song ID", "Label key", "Predicted key"]))
+            print_error_rates(error_rates)
             print(confusion_matrix)
         
         print("Overall error: %5.2f%%" % (error*100))
         
         if args.csv is not False:
             np.savetxt(args.csv, confusion_matrix)
+
+    if profiler is not None:
+        Profiler.dump(dict(profiler.report(), args=vars(args)), args.profile)
@@ -0,0 +1,129 @@
+import sqlite3
+from os import scandir, stat
+from os.path import exists, join
+
+from constants import AUDIO_ANALYSIS, AUDIO_FEATURES
+from tracklist import TrackList
+
+MANIFEST = 'manifest.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datapoints (
+    data_type TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    PRIMARY KEY (data_type, track_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tracks (
+    position INTEGER PRIMARY KEY,
+    track_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_track_id ON tracks (track_id);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+
+def get_manifest_path(output_dir) -> str:
+    return join(output_dir, MANIFEST)
+
+
+def get_file_signature(path) -> str:
+    if not exists(path):
+        return '-'
+    stat_result = stat(path)
+    return f'{stat_result.st_size}:{stat_result.st_mtime_ns}'
+
+
+class Manifest:
+    """
+    An SQLite index of the data points stored in an output directory and of its track list, so the check, count,
+    missing and obsolete commands don't need a syscall per track. store_datapoint() adds to it. It is built from the
+    files on disk when it doesn't exist yet; reindex() rebuilds it after files were added or removed by other means.
+    The track list is copied in, and copied again whenever track_list.pickle or track_list.log change.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        path = get_manifest_path(output_dir)
+        new = not exists(path)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+        if new:
+            self.reindex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def add(self, data_type, track_ids):
+        ''' Records stored data points. Call commit() to persist them. '''
+        self.connection.executemany('INSERT OR IGNORE INTO datapoints VALUES (?, ?)',
+                                    ((data_type, track_id) for track_id in track_ids))
+
+    def reindex(self):
+        ''' Rebuilds the data points from the files on disk and copies the track list again. Returns their counts. '''
+        counts = {}
+        self.connection.execute('DELETE FROM datapoints')
+        for data_type in [AUDIO_ANALYSIS, AUDIO_FEATURES]:
+            data_dir = join(self.output_dir, data_type)
+            if not exists(data_dir):
+                counts[data_type] = 0
+                continue
+            with scandir(data_dir) as entries:
+                self.add(data_type, (entry.name[:-len('.pickle')] for entry in entries
+                                     if entry.name.endswith('.pickle')))
+            counts[data_type] = self.count(data_type)
+        self.connection.execute("DELETE FROM meta WHERE name = 'track_list'")
+        self.commit()
+        return counts
+
+    def get_track_list_signature(self) -> str:
+        return ' '.join(get_file_signature(join(self.output_dir, name))
+                        for name in ['track_list.pickle', 'track_list.log'])
+
+    def sync_track_list(self):
+        # Only reloads the track list when its files changed since it was copied in
+        signature = self.get_track_list_signature()
+        row = self.connection.execute("SELECT value FROM meta WHERE name = 'track_list'").fetchone()
+        if row is not None and row[0] == signature:
+            return
+        track_ids = TrackList.load_from_dir(self.output_dir).get_track_ids()
+        self.connection.execute('DELETE FROM tracks')
+        self.connection.executemany('INSERT INTO tracks VALUES (?, ?)', enumerate(track_ids))
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('track_list', ?)", (signature,))
+        self.commit()
+
+    def count(self, data_type) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM datapoints WHERE data_type = ?', (data_type,)).fetchone()[0]
+
+    def count_tracks(self) -> int:
+        self.sync_track_list()
+        return self.connection.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+    def get_track_ids(self, data_type) -> list:
+        return [track_id for track_id, in self.connection.execute(
+            'SELECT track_id FROM datapoints WHERE data_type = ?', (data_type,))]
+
+    def get_missing(self, data_type) -> list:
+        ''' Track ids in the track list without a data point of data_type, in track list order. '''
+        self.sync_track_list()
+        return [track_id for track_id, in self.connection.execute(
+            'SELECT track_id FROM tracks WHERE track_id NOT IN '
+            '(SELECT track_id FROM datapoints WHERE data_type = ?) ORDER BY position', (data_type,))]
+
+    def get_obsolete(self, data_type) -> list:
+        ''' Track ids with a data point of data_type that are not in the track list. '''
+        self.sync_track_list()
+        return [track_id for track_id, in self.connection.execute(
+            'SELECT track_id FROM datapoints WHERE data_type = ? AND track_id NOT IN (SELECT track_id FROM tracks)',
+            (data_type,))]
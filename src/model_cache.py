@@ -0,0 +1,59 @@
+from hashlib import sha1
+from json import dumps
+from os import makedirs, remove, utime
+from os.path import exists, join
+from pathlib import Path
+
+
+class ModelCache:
+    """
+    A directory of trained models, stored with their save() method under a key derived from the dataset, fold and
+    hyperparameters. Keeps the total size under max_bytes by evicting the least recently used models.
+    """
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not exists(cache_dir):
+            makedirs(cache_dir)
+
+    @staticmethod
+    def key(**params) -> str:
+        return sha1(dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_path(self, key) -> str:
+        return join(self.cache_dir, key) + '.npz'
+
+    def load(self, key, model) -> bool:
+        # Loads the cached parameters into model, returns whether there were any
+        path = self.get_path(key)
+        if not exists(path):
+            return False
+        model.load(path)
+        utime(path)
+        return True
+
+    def store(self, key, model):
+        path = self.get_path(key)
+        tmp_path = path + '.tmp'
+        model.save(tmp_path)
+        Path(tmp_path).replace(path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in Path(self.cache_dir).glob('*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Evicted by another process in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            total -= size
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
@@ -1,5 +1,4 @@
 import numpy as np
-import copy
 
 class Naive_model:
 
@@ -31,55 +30,83 @@ class Naive_model:
     model[23,:] = [0, 1,  0, 1,  1, 0, 1,  0, 1,  0, 1,  1]
 
     def train(self, training_data_dict: dict, verbose=False):
-        teacher_vecs = {}
-        for i in range(0,24):
-            teacher_vecs[i] = []
-
         if verbose:
             print("Applying training samples...")
-        for track_id in training_data_dict:
-            track_data = training_data_dict[track_id]
-            vec = self.format_sequence(track_data)
-            teacher_vecs[track_data["mode"]*12 + track_data["key"]].append(vec)
+        vecs = np.empty((len(training_data_dict), 12))
+        labels = np.empty(len(training_data_dict), dtype=int)
+        for i, (track_id, track_data) in enumerate(training_data_dict.items()):
+            vecs[i] = self.format_sequence(track_data)
+            labels[i] = track_data["mode"]*12 + track_data["key"]
         if verbose:
             print("Done.")
         
         if verbose:
             print("Composing model...")
-        self.model = []
-        for i in range(0,24):
-            if len(teacher_vecs[i]) == 0:
-                self.model.append(-np.ones(12))
-            else:
-                self.model.append( np.average(np.array(teacher_vecs[i]), axis=0) )
+        # Average the chroma vectors per key in one go, keys without any training samples get -1 everywhere
+        sums = np.zeros((24, 12))
+        np.add.at(sums, labels, vecs)
+        counts = np.bincount(labels, minlength=24)
+        self.model = -np.ones((24, 12))
+        self.model[counts > 0] = sums[counts > 0] / counts[counts > 0, None]
         if verbose:
             print("Done.")
-        self.model = np.array(self.model)
         
     
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, **self.get_arrays())
+
+    def get_arrays(self):
+        return {'method': 'naive', 'model': self.model}
+
+    def load(self, path):
+        with np.load(path) as arrays:
+            self.set_arrays(arrays)
+        return self
+
+    def set_arrays(self, arrays):
+        self.model = arrays['model']
+
     def predict(self, test_sample: dict, mode=False):
-        avg_vec = self.format_sequence(test_sample)
-        scores = np.zeros(24)
+        scores = self.model @ self.format_sequence(test_sample)
         if mode is False:
-            for i in range(0, 24):
-                scores[i] = np.correlate(avg_vec, self.model[i])
+            return np.argmax(scores)
         elif mode == 0:
-            for i in range(0, 12):
-                scores[i] = np.correlate(avg_vec, self.model[i])
+            return np.argmax(scores[:12])
         else:
-            for i in range(12, 24):
-                scores[i] = np.correlate(avg_vec, self.model[i])
-        return np.argmax(scores)
+            return np.argmax(scores[12:]) + 12
+
+    def predict_batch(self, test_samples: list, mode=None):
+        return np.argmax(self.score_batch(test_samples, mode), axis=1)
+
+    def score_batch(self, test_samples: list, mode=None):
+        # Correlation of every sample with the 24 key vectors, -inf for the keys outside a given mode.
+        # mode is None, a single mode for all samples, or an array with the mode of every sample
+        modes = np.full(len(test_samples), -1) if mode is None else np.broadcast_to(mode, len(test_samples))
+        scores = self.format_batch(test_samples) @ self.model.T
+        scores[modes == 0, 12:] = -np.inf
+        scores[modes == 1, :12] = -np.inf
+        return scores
     
     
     def format_sequence(self, audio_analysis):
-        # Reformat data
-        num_segments = len(audio_analysis["pitches"])
-        input_data = np.zeros((num_segments, 13))
-        for i in range(num_segments):
-            input_data[i,0]  = audio_analysis["duration"][i]
-            input_data[i,1:] = audio_analysis["pitches"][i]
-        
-        # Return weighted average chroma key vector
-        avg_vec = np.average(input_data[:,1:], axis=0, weights=input_data[:,0])
-        return avg_vec
\ No newline at end of file
+        # Return weighted average chroma key vector, tracks from a packed store carry it already (see features.py)
+        if "mean_chroma" in audio_analysis:
+            return audio_analysis["mean_chroma"]
+        return np.average(audio_analysis["pitches"], axis=0, weights=audio_analysis["duration"])
+
+    def format_batch(self, audio_analyses: list):
+        # Weighted average chroma key vectors of all samples, as one weighted reduction over all their segments
+        if len(audio_analyses) > 0 and all("mean_chroma" in audio_analysis for audio_analysis in audio_analyses):
+            return np.array([audio_analysis["mean_chroma"] for audio_analysis in audio_analyses])
+        lengths = np.array([len(audio_analysis["pitches"]) for audio_analysis in audio_analyses])
+        if len(lengths) == 0:
+            return np.zeros((0, 12))
+        # reduceat would take the next sample's first segment for a sample without any
+        if np.any(lengths == 0):
+            raise ValueError('samples %s have no segments' % np.flatnonzero(lengths == 0).tolist())
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        pitches = np.concatenate([audio_analysis["pitches"] for audio_analysis in audio_analyses])
+        durations = np.concatenate([audio_analysis["duration"] for audio_analysis in audio_analyses])
+        weighted = np.add.reduceat(pitches * durations[:, None], offsets, axis=0)
+        return weighted / np.add.reduceat(durations, offsets)[:, None]
@@ -1,61 +1,43 @@
-from key_recognition import run_key_recognition
-from argparse import Namespace, ArgumentParser
+from argparse import ArgumentParser
 from tabulate import tabulate
+from sweep import run_sweep, summarize, summary_headers
 import numpy as np
-import multiprocessing 
+import multiprocessing
 
 if __name__ == '__main__':
     # Get hyperargs
     arg_parser = ArgumentParser()
-    arg_parser.add_argument('--n_components', default=3, type=int, help='''
-        Amount of components ('hidden states') to use for HMM training.
+    arg_parser.add_argument('--n_components', default=[3], type=int, nargs='+', help='''
+        Amount(s) of components ('hidden states') to use for HMM training.
         ''')
-    arg_parser.add_argument('--n_iter', default=100, type=int, help='''
-        (Maximum) amount of iterations used in HMM training.
+    arg_parser.add_argument('--n_iter', default=[100], type=int, nargs='+', help='''
+        (Maximum) amount(s) of iterations used in HMM training.
         ''')
-    arg_parser.add_argument('--subset', default=1000, type=int, help='''
-        Samples to use.
+    arg_parser.add_argument('--subset', default=0, type=int, help='''
+        Samples to use. Uses all samples when 0.
         ''')
-    hyperargs = arg_parser.parse_args()
+    sweep_args = arg_parser.parse_args()
+    sweep_args.data_dir = 'dataset'
+    sweep_args.mixture = False
+    sweep_args.give_mode = True
+    sweep_args.window_seconds = 20
+    sweep_args.folds = 10
+    cpus = multiprocessing.cpu_count()
+    sweep_args.workers = cpus if cpus < 10 else 10
 
-    # Get args - manually create Namespace object
-    args = Namespace()
-    args.data_dir = 'dataset'
-    args.dry = False
-    args.table = True
-    args.verbose = True
-    args.give_mode = True
-    args.method = 'hmm'
-    args.mixture = False
-    args.cross_validation = True
-    args.test_split = 10
-    args.n_components = hyperargs.n_components
-    args.n_iter = hyperargs.n_iter
-    args.subset = hyperargs.subset
-    args.csv = True
+    # Run k-fold CV of every configuration in parallel
+    print(f"Running {sweep_args.folds}-fold CV in parallel.")
+    print(f"[n_components={sweep_args.n_components}, n_iter={sweep_args.n_iter}]")
+    configs, results = run_sweep(sweep_args, verbose=False)
 
-    # Function to run on 1 fold
-    def run_fold(fold):
-        print(f"[Split {fold}]")
-        error, results_table, confusion_matrix = run_key_recognition(\
-            args, verbose=False, test_split_index=fold)
-        print("Overall error: %5.2f%%" % (error*100))
-        if args.table:
-            print(tabulate(results_table,\
-                headers=["Song ID", "Label key","Predicted key"]))
+    # Report folds in order, peregrine_postprocess.sh collects the "Overall error" lines
+    for args, fold_results in zip(configs, results):
+        for fold, (error, confusion_matrix, _, _) in enumerate(fold_results):
+            print(f"[Split {fold}]")
+            print("Overall error: %5.2f%%" % (error*100))
             print(confusion_matrix)
-        if args.csv is not False:
             filename = 'logs/n_components={},n_iter={},fold={}.csv'\
                 .format(args.n_components, args.n_iter, fold)
             np.savetxt(filename, confusion_matrix)
-
-    # Run k-fold CV in parallel
-    print(f"Running {args.test_split}-fold CV in parallel.")
-    print(f"[n_components={args.n_components}, n_iter={args.n_iter}]")
-    cpus = multiprocessing.cpu_count()
-    processes = cpus if cpus < 10 else 10
-    pool = multiprocessing.Pool(processes=processes,)
-    pool.map(run_fold, range(args.test_split))
-    pool.close()
-    pool.join()
-    print('Done!')
\ No newline at end of file
+    print(tabulate(summarize(configs, results), headers=summary_headers, floatfmt='.2f'))
+    print('Done!')
@@ -1,3 +1,5 @@
+from operator import itemgetter
+
 import numpy as np
 
 def extract_audio_features(audio_features):
@@ -16,29 +18,36 @@ def extract_track_analysis(track_analysis):
         "mode": track_analysis['track']['mode'],
         "mode_confidence": track_analysis['track']['mode_confidence']
     }
+    # All segments are stored, the time window is applied when the data is loaded (see window_analysis)
     track_object['pitches'], track_object['start'], track_object['duration'], track_object['confidence'] =\
-        format_first_n_seconds_segments(track_analysis['segments'], 20)
+        format_segments(track_analysis['segments'])
     return track_object
 
-def format_first_n_seconds_segments(segments, secs):
-    ''' Transforms the chroma vectors, start, duration and condifidence values for each
-    segment to numpy arrays up to a certain initial amount of seconds.
+def format_segments(segments):
+    ''' Transforms the chroma vectors, start, duration and confidence values of all segments to numpy arrays.
+    '''
+    n = len(segments)
+    chroma_vecs = np.array(list(map(itemgetter('pitches'), segments)), dtype=float).reshape(n, 12)
+    start_vec = np.fromiter(map(itemgetter('start'), segments), dtype=float, count=n)
+    duration_vec = np.fromiter(map(itemgetter('duration'), segments), dtype=float, count=n)
+    confidence_vec = np.fromiter(map(itemgetter('confidence'), segments), dtype=float, count=n)
+    return chroma_vecs, start_vec, duration_vec, confidence_vec
+
+def get_window_length(start, duration, secs):
+    ''' The amount of segments up to and including the first one that ends at or after secs. '''
+    ends = np.flatnonzero(np.asarray(start) + np.asarray(duration) >= secs)
+    return ends[0] + 1 if len(ends) > 0 else len(start)
+
+def window_analysis(analysis, secs):
+    ''' The analysis with only the segments of the first secs seconds of the track. Returns it as is when secs is falsy.
     '''
-    num_segments = len(segments)
-    start_vec       = np.zeros(num_segments)
-    duration_vec    = np.zeros(num_segments)
-    confidence_vec  = np.zeros(num_segments)
-    chroma_vecs     = np.zeros( (num_segments, 12) )
-    idx = 0
-    for segment in segments:
-        start_vec[idx] = segment['start']
-        duration_vec[idx] = segment['duration']
-        confidence_vec[idx] = segment['confidence']
-        chroma_vecs[idx,:] = segment["pitches"]
-        idx += 1
-        if segment['start'] + segment['duration'] >= secs:
-            break
-    return chroma_vecs[:idx,:], start_vec[:idx], duration_vec[:idx], confidence_vec[:idx]
+    if not secs:
+        return analysis
+    n = get_window_length(analysis['start'], analysis['duration'], secs)
+    windowed = dict(analysis)
+    for name in ['pitches', 'start', 'duration', 'confidence']:
+        windowed[name] = analysis[name][:n]
+    return windowed
 
 
 def extract_segment(segment):
@@ -0,0 +1,69 @@
+import resource
+import sys
+from contextlib import contextmanager
+from json import dump
+from time import perf_counter
+
+import numpy as np
+
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def get_percentiles(values, percentiles=(50, 90, 99)):
+    if len(values) == 0:
+        return {}
+    result = {f'p{p}': float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))}
+    result['max'] = float(np.max(values))
+    return result
+
+
+class Profiler:
+    """
+    Collects the wall time and peak RSS of every stage of a run, plus any other statistics, into a JSON report. Only
+    reads a clock and getrusage() per stage and per prediction batch, so it is cheap enough to always leave on.
+    """
+    def __init__(self):
+        self.stages = []
+        self.stats = {}
+        self.latencies = []
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({
+                'stage': name,
+                'seconds': perf_counter() - start,
+                # High-water marks, so a stage that raises them is the one that used the memory
+                'peak_rss_mb': get_peak_rss_mb(),
+                'children_peak_rss_mb': get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+            })
+
+    def add_batch(self, n_tracks, seconds):
+        # Every track in a batch waits for the whole batch
+        self.latencies.append((n_tracks, seconds))
+
+    def report(self) -> dict:
+        report = {'stages': self.stages}
+        report.update(self.stats)
+        if self.latencies:
+            n_tracks = np.array([n for n, _ in self.latencies])
+            seconds = np.array([s for _, s in self.latencies])
+            report['prediction'] = {
+                'tracks': int(n_tracks.sum()),
+                'batches': len(self.latencies),
+                'ms_per_track': float(seconds.sum() * 1000 / max(n_tracks.sum(), 1)),
+                'latency_ms': get_percentiles(np.repeat(seconds * 1000, n_tracks)),
+            }
+        return report
+
+    @staticmethod
+    def dump(report, path):
+        with open(path, 'w') as f:
+            dump(report, f, indent=2, default=str)
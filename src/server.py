@@ -0,0 +1,276 @@
+"""
+A resident key recognition server. Loads a model saved with `key_recognition.py --save-model` once and classifies tracks
+posted to it in the format of process.extract_track_analysis. Tracks of concurrent requests are grouped into
+micro-batches that are scored at once. The model file is reloaded when it changes, requests keep being served by the
+old model until the new one is loaded.
+
+    POST /predict  {"tracks": [{"id": ..., "pitches": [[12 values], ...], "start": [...], "duration": [...]}, ...],
+                    "give_mode": false}
+    POST /reload
+    GET  /health
+"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from os.path import getmtime
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import monotonic, sleep, time
+
+import numpy as np
+
+from cascade_model import Cascade_model
+from evaluation import key_nums, modes
+from hmm_model import HMM_model
+from naive_model import Naive_model
+from process import window_analysis
+
+
+def get_args():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--model', required=True, type=str, help='''
+        The .npz file of a model saved with key_recognition.py --save-model.
+        ''')
+    arg_parser.add_argument('--host', default='127.0.0.1', type=str, help='''
+        The address to serve on.
+        ''')
+    arg_parser.add_argument('--port', default=8000, type=int, help='''
+        The port to serve on.
+        ''')
+    arg_parser.add_argument('--max-batch', default=256, type=int, help='''
+        Maximum amount of tracks to score at once.
+        ''')
+    arg_parser.add_argument('--max-wait-ms', default=5.0, type=float, help='''
+        Maximum time to wait for more requests to fill a batch, in milliseconds.
+        ''')
+    arg_parser.add_argument('--window-seconds', default=20, type=float, help='''
+        Only use the segments of the first N seconds of every track, like the model was trained. Uses the whole track
+        when 0.
+        ''')
+    arg_parser.add_argument('--reload-interval', default=1.0, type=float, help='''
+        How often to check the model file for changes, in seconds. Never checks when 0.
+        ''')
+    return arg_parser.parse_args()
+
+
+def load_model(path):
+    ''' The model in a file saved with --save-model, and its method. '''
+    with np.load(path) as arrays:
+        method = str(arrays['method'])
+    if method == 'cascade':
+        with np.load(path) as arrays:
+            cutoff = float(arrays['cutoff'])
+            model = Cascade_model(HMM_model(), int(arrays['top_k']), None if np.isnan(cutoff) else cutoff)
+    else:
+        model = Naive_model() if method == 'naive' else HMM_model()
+    model.load(path)
+    if method != 'naive':
+        # Factorise the emissions now, rather than in the first batch
+        model.get_scorers()
+    return model, method
+
+
+def parse_track(analysis, window_seconds):
+    pitches = np.asarray(analysis['pitches'], dtype=np.float32).reshape(-1, 12)
+    if len(pitches) == 0:
+        raise ValueError('a track needs at least one segment')
+    track = {
+        'pitches': pitches,
+        'start': np.asarray(analysis['start'], dtype=np.float32),
+        'duration': np.asarray(analysis['duration'], dtype=np.float32),
+        'confidence': np.asarray(analysis.get('confidence', np.ones(len(pitches))), dtype=np.float32),
+    }
+    if any(len(track[name]) != len(pitches) for name in ['start', 'duration', 'confidence']):
+        raise ValueError('pitches, start, duration and confidence must have a value for every segment')
+    return window_analysis(track, window_seconds)
+
+
+class ModelHolder:
+    """ The model being served. reload() loads the model file again and swaps it in once it is loaded. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.mtime = getmtime(path)
+        self.model, self.method = load_model(path)
+        self.loaded_at = time()
+        self.reloads = 0
+
+    def reload(self):
+        with self.lock:
+            mtime = getmtime(self.path)
+            model, method = load_model(self.path)
+            self.model, self.method, self.mtime, self.loaded_at = model, method, mtime, time()
+            self.reloads += 1
+
+    def watch(self, interval):
+        while True:
+            sleep(interval)
+            try:
+                if getmtime(self.path) != self.mtime:
+                    self.reload()
+                    print(f'reloaded {self.path}')
+            except Exception as e:
+                # E.g. the file is still being written, try again on the next check
+                print(f'could not reload {self.path}: {e}')
+
+
+class Request:
+    def __init__(self, tracks, modes):
+        self.tracks = tracks
+        self.modes = modes
+        self.done = Event()
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Collects the tracks of concurrent requests into batches of up to max_batch tracks, waiting at most max_wait seconds
+    for a batch to fill, and scores every batch at once on a single worker thread.
+    """
+    def __init__(self, holder, max_batch=256, max_wait=0.005):
+        self.holder = holder
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.batches = 0
+        self.tracks = 0
+        Thread(target=self.run, daemon=True).start()
+
+    def submit(self, tracks, modes):
+        request = Request(tracks, modes)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def next_batch(self):
+        requests = [self.queue.get()]
+        n_tracks = len(requests[0].tracks)
+        deadline = monotonic() + self.max_wait
+        while n_tracks < self.max_batch:
+            try:
+                request = self.queue.get(timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                break
+            requests.append(request)
+            n_tracks += len(request.tracks)
+        return requests
+
+    def run(self):
+        while True:
+            requests = self.next_batch()
+            try:
+                scores = self.holder.model.score_batch([track for request in requests for track in request.tracks],
+                                                       np.concatenate([request.modes for request in requests]))
+                offset = 0
+                for request in requests:
+                    request.scores = scores[offset:offset + len(request.tracks)]
+                    offset += len(request.tracks)
+                self.batches += 1
+                self.tracks += offset
+            except Exception:
+                # Score the requests of the batch one by one, so only the request that caused the error fails
+                for request in requests:
+                    try:
+                        request.scores = self.holder.model.score_batch(request.tracks, request.modes)
+                        self.batches += 1
+                        self.tracks += len(request.tracks)
+                    except Exception as e:
+                        request.error = e
+            for request in requests:
+                request.done.set()
+
+
+def get_prediction(track_id, scores):
+    estimate = int(np.argmax(scores))
+    return {
+        'id': track_id,
+        'key': estimate % 12,
+        'mode': estimate // 12,
+        'label': f'{key_nums[estimate % 12]} {modes[estimate // 12]}',
+        # -inf (keys outside a given mode) is not valid JSON
+        'scores': [float(score) if np.isfinite(score) else None for score in scores],
+    }
+
+
+def make_handler(holder, batcher, window_seconds):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # The headers and the body are separate writes, which would otherwise wait for the client's delayed ACK on
+        # keep-alive connections
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload):
+            body = dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_json(404, {'error': 'not found'})
+            self.send_json(200, {
+                'model': holder.path,
+                'method': holder.method,
+                'loaded_at': holder.loaded_at,
+                'reloads': holder.reloads,
+                'batches': batcher.batches,
+                'tracks': batcher.tracks,
+            })
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/reload':
+                try:
+                    holder.reload()
+                except Exception as e:
+                    return self.send_json(500, {'error': str(e)})
+                return self.send_json(200, {'reloads': holder.reloads})
+            if self.path != '/predict':
+                return self.send_json(404, {'error': 'not found'})
+            try:
+                request = loads(body)
+                analyses = request['tracks']
+                tracks = [parse_track(analysis, window_seconds) for analysis in analyses]
+                given_modes = np.array([analysis['mode'] if request.get('give_mode') else -1 for analysis in analyses],
+                                       dtype=int)
+            except (ValueError, KeyError, TypeError) as e:
+                return self.send_json(400, {'error': f'invalid request: {e!r}'})
+            if len(tracks) == 0:
+                return self.send_json(200, {'predictions': []})
+            try:
+                scores = batcher.submit(tracks, given_modes)
+            except Exception as e:
+                return self.send_json(500, {'error': str(e)})
+            self.send_json(200, {'predictions': [
+                get_prediction(analysis.get('id'), track_scores) for analysis, track_scores in zip(analyses, scores)
+            ]})
+
+    return Handler
+
+
+def serve(model_path, host='127.0.0.1', port=8000, max_batch=256, max_wait_ms=5.0, window_seconds=20,
+          reload_interval=1.0):
+    holder = ModelHolder(model_path)
+    batcher = MicroBatcher(holder, max_batch, max_wait_ms / 1000)
+    if reload_interval > 0:
+        Thread(target=holder.watch, args=(reload_interval,), daemon=True).start()
+    server = ThreadingHTTPServer((host, port), make_handler(holder, batcher, window_seconds))
+    server.daemon_threads = True
+    print(f'Serving {model_path} on http://{host}:{server.server_port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    serve(args.model, args.host, args.port, args.max_batch, args.max_wait_ms, args.window_seconds,
+          args.reload_interval)
@@ -0,0 +1,124 @@
+from threading import Lock
+from time import monotonic, perf_counter, sleep, time
+
+from dateutil.parser import parse
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from authorize import get_token
+
+
+def isfloat(flt):
+    try:
+        float(flt)
+        return True
+    except ValueError:
+        return False
+
+
+def get_retry_after_seconds(retry_after):
+    # It is either a float  or an HTTP date
+    if not isfloat(retry_after):
+        return max(parse(retry_after).timestamp() - time(), 0)
+    return max(float(retry_after), 0)
+
+
+class TokenBucket:
+    """
+    Rate limiter shared by all threads of a client: allows `rate` requests per second on average, in bursts of at most
+    `capacity`. When the server asks to back off, block() stops every thread until the Retry-After has passed.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                if now >= self.blocked_until:
+                    self.tokens = min(self.capacity, self.tokens + max(now - self.updated, 0) * self.rate)
+                    self.updated = max(now, self.updated)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.blocked_until - now
+            sleep(wait)
+
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+            # Start refilling from empty once the block is over
+            self.tokens = 0
+            self.updated = self.blocked_until
+
+
+class SpotifyClient:
+    """
+    Thread-safe client for the Spotify Web API. Keeps a pool of `concurrency` connections, shares one TokenBucket
+    between all threads, honours the Retry-After header of responses and refreshes the access token when it expires.
+    """
+    def __init__(self, concurrency=8, rate=20.0, max_retries=5):
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = TokenBucket(rate)
+        self.max_retries = max_retries
+        self.token = None
+        self.token_lock = Lock()
+        # Statistics, for benchmarking
+        self.stats_lock = Lock()
+        self.retries = 0
+        self.rate_limited = 0
+        self.latencies = []
+
+    def get_headers(self):
+        with self.token_lock:
+            if self.token is None or time() >= self.token['expire_time'] - 1:
+                self.token = get_token()
+            return {'Authorization': f"{self.token['token_type']} {self.token['access_token']}"}
+
+    def refresh_token(self, headers):
+        with self.token_lock:
+            # Another thread may have refreshed it already
+            if self.token is not None and headers['Authorization'].endswith(self.token['access_token']):
+                self.token = get_token(force=True)
+
+    def get(self, url, params=None):
+        """ GET url, retrying until the response is a 200 or a 404. """
+        attempts = 0
+        while True:
+            self.limiter.acquire()
+            headers = self.get_headers()
+            start = perf_counter()
+            response = self.session.get(url, headers=headers, params=params)
+            self.latencies.append(perf_counter() - start)
+            if response.status_code in [200, 404]:
+                return response
+            if response.status_code == 429 or 'Retry-After' in response.headers:
+                retry_after = response.headers.get('Retry-After', '1')
+                print(f"Got status code {response.status_code} with a Retry-After header. Retrying after {retry_after}")
+                with self.stats_lock:
+                    self.rate_limited += 1
+                    self.retries += 1
+                self.limiter.block(get_retry_after_seconds(retry_after))
+                continue
+            if attempts < self.max_retries and (response.status_code == 401 or response.status_code >= 500):
+                if response.status_code == 401:
+                    self.refresh_token(headers)
+                else:
+                    sleep(0.5 * 2 ** attempts)
+                attempts += 1
+                with self.stats_lock:
+                    self.retries += 1
+                continue
+            print(response)
+            print(response.reason)
+            raise Exception("Unexpected non-200 status code")
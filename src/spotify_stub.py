@@ -0,0 +1,165 @@
+"""
+A local stand-in for the parts of the Spotify Web API that the ingestion pipeline uses: the token endpoint,
+audio-features and audio-analysis. Payloads are synthetic but deterministic per track id. Rate limiting (429 with
+Retry-After), missing tracks (404) and latency can be injected. Point the pipeline at it with:
+
+    SPOTIFY_API_URL=http://localhost:<port>/v1 SPOTIFY_ACCOUNTS_URL=http://localhost:<port>
+"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from multiprocessing import Pipe, Process
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+from zlib import crc32
+
+import numpy as np
+
+
+def get_args():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--port', default=8080, type=int, help='''
+        The port to serve on.
+        ''')
+    add_stub_arguments(arg_parser)
+    return arg_parser.parse_args()
+
+
+def add_stub_arguments(arg_parser):
+    arg_parser.add_argument('--latency-ms', default=0.0, type=float, help='''
+        Mean latency added to every response, in milliseconds (exponentially distributed).
+        ''')
+    arg_parser.add_argument('--rate-limit', default=0.0, type=float, help='''
+        Fraction of requests to answer with a 429.
+        ''')
+    arg_parser.add_argument('--retry-after', default='1', type=str, help='''
+        Retry-After header value sent with every 429, in seconds or as an HTTP date.
+        ''')
+    arg_parser.add_argument('--not-found', default=0.0, type=float, help='''
+        Fraction of tracks for which audio-analysis answers with a 404.
+        ''')
+    arg_parser.add_argument('--segments', default=600, type=int, help='''
+        Amount of segments in every synthetic audio analysis.
+        ''')
+    arg_parser.add_argument('--seed', default=0, type=int, help='''
+        Seed for the synthetic payloads and injected faults.
+        ''')
+
+
+def track_rng(track_id, seed):
+    return np.random.RandomState((crc32(track_id.encode()) + seed) % (1 << 32))
+
+
+def synthetic_features(track_id, seed):
+    rng = track_rng(track_id, seed)
+    return {'id': track_id, 'key': int(rng.randint(12)), 'mode': int(rng.randint(2)), 'type': 'audio_features'}
+
+
+def synthetic_analysis(track_id, seed, n_segments):
+    features = synthetic_features(track_id, seed)
+    rng = track_rng(track_id, seed + 1)
+    durations = rng.uniform(0.1, 0.5, n_segments).round(5)
+    starts = np.concatenate(([0], np.cumsum(durations)[:-1])).round(5)
+    # Chroma that follows the scale of the track's key, so the models have something to learn
+    scale = np.array([1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1] if features['mode'] == 1 else
+                     [1, 0, 1, 1, 0, 1, 0, 1, 1, 0, 1, 0], dtype=float)
+    pitches = np.clip(np.roll(scale, features['key']) * rng.rand(n_segments, 12) + .3 * rng.rand(n_segments, 12), 0, 1)
+    timbre = rng.normal(0, 50, (n_segments, 12))
+    return {
+        'track': {
+            'duration': float(starts[-1] + durations[-1]) if n_segments > 0 else 0.,
+            'key': features['key'],
+            'key_confidence': float(rng.rand()),
+            'mode': features['mode'],
+            'mode_confidence': float(rng.rand()),
+            'tempo': float(rng.uniform(60, 180)),
+        },
+        'segments': [{
+            'start': float(starts[i]),
+            'duration': float(durations[i]),
+            'confidence': float(rng.rand()),
+            'loudness_start': float(rng.uniform(-60, 0)),
+            'pitches': pitches[i].round(3).tolist(),
+            'timbre': timbre[i].round(3).tolist(),
+        } for i in range(n_segments)],
+    }
+
+
+def make_handler(options):
+    fault_rng = np.random.RandomState(options.seed)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # The headers and the body are separate writes, which would otherwise wait for the client's delayed ACK on
+        # keep-alive connections
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload=None, headers=None):
+            body = dumps(payload).encode() if payload is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def delay_and_limit(self):
+            if options.latency_ms > 0:
+                sleep(fault_rng.exponential(options.latency_ms / 1000))
+            if fault_rng.rand() < options.rate_limit:
+                self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}},
+                               {'Retry-After': options.retry_after})
+                return True
+            return False
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if urlparse(self.path).path != '/api/token':
+                return self.send_json(404)
+            self.send_json(200, {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if self.delay_and_limit():
+                return
+            if url.path == '/v1/audio-features':
+                track_ids = parse_qs(url.query).get('ids', [''])[0].split(',')
+                return self.send_json(200, {'audio_features': [
+                    synthetic_features(track_id, options.seed) for track_id in track_ids if track_id
+                ]})
+            if url.path.startswith('/v1/audio-analysis/'):
+                track_id = url.path.split('/')[-1]
+                if track_rng(track_id, options.seed + 2).rand() < options.not_found:
+                    return self.send_json(404, {'error': {'status': 404, 'message': 'analysis not found'}})
+                return self.send_json(200, synthetic_analysis(track_id, options.seed, options.segments))
+            self.send_json(404)
+
+    return Handler
+
+
+def serve(options, port=8080, connection=None):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(options))
+    server.daemon_threads = True
+    if connection is not None:
+        connection.send(server.server_port)
+    server.serve_forever()
+
+
+def start_stub_process(options):
+    ''' Serves the stand-in in a separate process on a free port. Returns the process and the base URL. '''
+    parent, child = Pipe()
+    process = Process(target=serve, args=(options, 0, child), daemon=True)
+    process.start()
+    return process, f'http://127.0.0.1:{parent.recv()}'
+
+
+if __name__ == '__main__':
+    args = get_args()
+    print(f'Serving on http://127.0.0.1:{args.port}, use:')
+    print(f'export SPOTIFY_API_URL=http://127.0.0.1:{args.port}/v1 SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:{args.port}')
+    serve(args, args.port)
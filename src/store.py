@@ -0,0 +1,374 @@
+from glob import glob
+from multiprocessing.shared_memory import SharedMemory
+from os import makedirs, remove, replace
+from os.path import exists, join
+
+import numpy as np
+
+from constants import PACKED_STORE
+from features import FEATURE_VERSIONS, get_chroma_sums, get_feature_path, get_mean_chroma
+from process import get_window_length
+
+# Column layout of the segments array: the segment start, duration and confidence
+START = 0
+DURATION = 1
+CONFIDENCE = 2
+N_COLUMNS = 3
+
+LABEL_DTYPE = np.dtype([
+    ('key', np.int8),
+    ('mode', np.int8),
+    ('key_confidence', np.float32),
+    ('mode_confidence', np.float32),
+])
+
+
+def quantize_chroma(pitches):
+    return np.round(np.clip(pitches, 0, 1) * 255).astype(np.uint8)
+
+
+def dequantize_chroma(pitches):
+    return pitches.astype(np.float32) * np.float32(1 / 255)
+
+
+class Track:
+    """
+    Compact record of a track: the chroma vectors and segment columns as float32 arrays and the labels as scalars.
+    Subscriptable like an analysis dict, so the models accept either. Tracks loaded from a store can also carry the
+    derived features of features.py, which the models then use rather than computing them; without them, `in` is False.
+    """
+    __slots__ = ['id', 'key', 'mode', 'key_confidence', 'mode_confidence', 'pitches', 'start', 'duration',
+                 'confidence', 'mean_chroma']
+
+    def __init__(self, id, key, mode, key_confidence, mode_confidence, pitches, start, duration, confidence,
+                 mean_chroma=None):
+        self.id = id
+        self.key = key
+        self.mode = mode
+        self.key_confidence = key_confidence
+        self.mode_confidence = mode_confidence
+        self.pitches = pitches
+        self.start = start
+        self.duration = duration
+        self.confidence = confidence
+        self.mean_chroma = mean_chroma
+
+    def __getitem__(self, name):
+        try:
+            value = getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return name in self.__slots__ and getattr(self, name) is not None
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        return cls(
+            analysis['id'],
+            int(analysis['key']),
+            int(analysis['mode']),
+            float(analysis['key_confidence']),
+            float(analysis['mode_confidence']),
+            np.asarray(analysis['pitches'], dtype=np.float32),
+            np.asarray(analysis['start'], dtype=np.float32),
+            np.asarray(analysis['duration'], dtype=np.float32),
+            np.asarray(analysis['confidence'], dtype=np.float32),
+        )
+
+
+def get_store_dir(output_dir) -> str:
+    return join(output_dir, PACKED_STORE)
+
+
+def have_store(output_dir) -> bool:
+    return exists(join(get_store_dir(output_dir), 'offsets.npy'))
+
+
+class PackedStore:
+    """
+    All audio analysis objects of a dataset as flat arrays of segment rows: float32 (or uint8-quantized) chroma vectors
+    and float32 segment columns, with an offsets index into them and a table of key/mode labels. Opened with mmap, so
+    loading a track is a slice rather than an unpickle. features holds the derived feature arrays of features.py that
+    the store has in their current version, with a row for every segment row.
+    """
+    def __init__(self, pitches, segments, offsets, labels, track_ids, features=None):
+        self.pitches = pitches
+        self.segments = segments
+        self.offsets = offsets
+        self.labels = labels
+        self.track_ids = track_ids
+        self.features = features if features is not None else {}
+        self.index = {track_id: i for i, track_id in enumerate(track_ids)}
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @property
+    def nbytes(self):
+        return self.pitches.nbytes + self.segments.nbytes + self.offsets.nbytes + self.labels.nbytes + \
+            sum(feature.nbytes for feature in self.features.values())
+
+    def have_track_id(self, track_id: str):
+        return track_id in self.index
+
+    def get_track(self, i: int, window_seconds=None) -> Track:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        segments = self.segments[start:end]
+        if window_seconds:
+            segments = segments[:get_window_length(segments[:, START], segments[:, DURATION], window_seconds)]
+        pitches = self.pitches[start:start + len(segments)]
+        if pitches.dtype == np.uint8:
+            pitches = dequantize_chroma(pitches)
+        mean_chroma = None
+        if 'chroma_sums' in self.features:
+            mean_chroma = get_mean_chroma(self.features['chroma_sums'][start:end], len(segments))
+        label = self.labels[i]
+        return Track(
+            str(self.track_ids[i]),
+            int(label['key']),
+            int(label['mode']),
+            float(label['key_confidence']),
+            float(label['mode_confidence']),
+            pitches,
+            segments[:, START],
+            segments[:, DURATION],
+            segments[:, CONFIDENCE],
+            mean_chroma,
+        )
+
+    def get_track_pitches(self, i: int):
+        pitches = self.pitches[self.offsets[i]:self.offsets[i + 1]]
+        return dequantize_chroma(pitches) if pitches.dtype == np.uint8 else pitches
+
+    def load_analysis(self, track_id: str, window_seconds=None) -> Track:
+        return self.get_track(self.index[track_id], window_seconds)
+
+    def subset(self, rows, window_seconds=None):
+        return StoreView(self, rows, window_seconds)
+
+    def share(self, features=False):
+        """
+        Copies the arrays into shared memory, so other processes can attach() to them without copying. The derived
+        features are only copied with features. Returns the shared memory blocks, which the caller has to close and
+        unlink when done, and the spec to attach with.
+        """
+        blocks = []
+        shared_features = self.features if features else {}
+        spec = {'track_ids': self.track_ids, 'features': list(shared_features)}
+        arrays = [(name, getattr(self, name)) for name in ['pitches', 'segments', 'offsets', 'labels']]
+        for name, array in arrays + list(shared_features.items()):
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            blocks.append(block)
+            spec[name] = (block.name, array.shape, array.dtype)
+        return blocks, spec
+
+    @classmethod
+    def open(cls, output_dir, mmap_mode='r'):
+        store_dir = get_store_dir(output_dir)
+        if exists(join(store_dir, 'pitches.npy')):
+            pitches = np.load(join(store_dir, 'pitches.npy'), mmap_mode=mmap_mode)
+            segments = np.load(join(store_dir, 'segments.npy'), mmap_mode=mmap_mode)
+        else:
+            # Stores compacted before the chroma and segment columns were split: one float64 array with both
+            values = np.load(join(store_dir, 'values.npy'), mmap_mode=mmap_mode)
+            pitches, segments = values[:, :12], values[:, 12:15]
+        return cls(
+            pitches,
+            segments,
+            np.load(join(store_dir, 'offsets.npy')),
+            np.load(join(store_dir, 'labels.npy')),
+            list(np.load(join(store_dir, 'track_ids.npy'))),
+            {name: np.load(get_feature_path(store_dir, name), mmap_mode=mmap_mode)
+             for name in FEATURE_VERSIONS if exists(get_feature_path(store_dir, name))},
+        )
+
+
+class StoreView:
+    """
+    The tracks at the given rows of a store, usable in place of a dict of analyses. The tracks are views into the
+    store's arrays, so nothing is copied. With window_seconds, only the segments of the first seconds are included.
+    """
+    def __init__(self, store, rows, window_seconds=None):
+        self.store = store
+        self.rows = np.asarray(rows)
+        self.window_seconds = window_seconds
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self.store.track_ids[row]
+
+    def __getitem__(self, track_id):
+        return self.store.load_analysis(track_id, self.window_seconds)
+
+    def keys(self):
+        return list(self)
+
+    def get_modes(self):
+        return self.store.labels['mode'][self.rows]
+
+    def get_lengths(self):
+        ''' The amount of segments of every track within the time window, without loading the tracks. '''
+        starts, ends = self.store.offsets[self.rows], self.store.offsets[self.rows + 1]
+        if not self.window_seconds:
+            return (ends - starts).astype(int)
+        segments = self.store.segments
+        return np.array([get_window_length(segments[start:end, START], segments[start:end, DURATION],
+                                           self.window_seconds) for start, end in zip(starts, ends)], dtype=int)
+
+    def values(self):
+        for row in self.rows:
+            yield self.store.get_track(row, self.window_seconds)
+
+    def items(self):
+        for row in self.rows:
+            yield self.store.track_ids[row], self.store.get_track(row, self.window_seconds)
+
+
+def attach(spec) -> PackedStore:
+    """ Opens a store from a spec made by PackedStore.share(), or from {'dir': output_dir} for a store on disk. """
+    if 'dir' in spec:
+        return PackedStore.open(spec['dir'])
+    arrays = {}
+    blocks = []
+    for name in ['pitches', 'segments', 'offsets', 'labels'] + spec['features']:
+        block_name, shape, dtype = spec[name]
+        block = SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        blocks.append(block)
+    store = PackedStore(arrays['pitches'], arrays['segments'], arrays['offsets'], arrays['labels'], spec['track_ids'],
+                        {name: arrays[name] for name in spec['features']})
+    store.blocks = blocks
+    return store
+
+
+def get_pitch_rows(analysis, quantize=False):
+    pitches = np.asarray(analysis['pitches']).reshape(-1, 12)
+    return quantize_chroma(pitches) if quantize else pitches.astype(np.float32)
+
+
+def get_segment_rows(analysis):
+    segments = np.empty((len(analysis['start']), N_COLUMNS), dtype=np.float32)
+    segments[:, START] = analysis['start']
+    segments[:, DURATION] = analysis['duration']
+    segments[:, CONFIDENCE] = analysis['confidence']
+    return segments
+
+
+def get_label(analysis):
+    return analysis['key'], analysis['mode'], analysis['key_confidence'], analysis['mode_confidence']
+
+
+def write_features(store, store_dir=None):
+    """
+    Computes the derived features of features.py for every track of store and adds them to it. With store_dir, they
+    are streamed into .npy files there, replacing those of other versions, else they are kept in memory.
+    """
+    n_rows = int(store.offsets[-1])
+    shapes = {'chroma_sums': ((n_rows, 13), np.float32)}
+    features = {}
+    for name, (shape, dtype) in shapes.items():
+        if store_dir is None:
+            features[name] = np.empty(shape, dtype=dtype)
+        else:
+            features[name] = np.lib.format.open_memmap(get_feature_path(store_dir, name) + '.tmp', mode='w+',
+                                                       dtype=dtype, shape=shape)
+    for i in range(len(store)):
+        start, end = store.offsets[i], store.offsets[i + 1]
+        features['chroma_sums'][start:end] = get_chroma_sums(store.get_track_pitches(i),
+                                                             store.segments[start:end, DURATION])
+    if store_dir is not None:
+        for name in shapes:
+            features[name].flush()
+            del features[name]
+            for path in glob(join(store_dir, f'{name}.v*.npy')):
+                remove(path)
+            replace(get_feature_path(store_dir, name) + '.tmp', get_feature_path(store_dir, name))
+            features[name] = np.load(get_feature_path(store_dir, name), mmap_mode='r')
+    store.features = features
+
+
+def pack_tracks(items, quantize=False, features=False) -> PackedStore:
+    """
+    Packs (track_id, analysis) pairs into an in-memory store, optionally with uint8-quantized chroma. With features,
+    the derived features are computed once for all its users.
+    """
+    offsets = [0]
+    labels = []
+    track_ids = []
+    pitch_chunks = [np.empty((0, 12), dtype=np.uint8 if quantize else np.float32)]
+    segment_chunks = [np.empty((0, N_COLUMNS), dtype=np.float32)]
+    for track_id, analysis in items:
+        pitch_chunks.append(get_pitch_rows(analysis, quantize))
+        segment_chunks.append(get_segment_rows(analysis))
+        offsets.append(offsets[-1] + len(segment_chunks[-1]))
+        labels.append(get_label(analysis))
+        track_ids.append(track_id)
+    store = PackedStore(np.concatenate(pitch_chunks), np.concatenate(segment_chunks), np.array(offsets, dtype=np.int64),
+                        np.array(labels, dtype=LABEL_DTYPE), track_ids)
+    if features:
+        write_features(store)
+    return store
+
+
+def raw_to_npy(raw_path, npy_path, dtype, shape):
+    """ Copies the rows in a raw file into a proper .npy file now that the final shape is known. """
+    array = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=shape)
+    if shape[0] > 0:
+        raw = np.memmap(raw_path, mode='r', dtype=dtype, shape=shape)
+        chunk = 1 << 20
+        for i in range(0, shape[0], chunk):
+            array[i:i + chunk] = raw[i:i + chunk]
+        del raw
+    array.flush()
+    del array
+    remove(raw_path)
+
+
+def write_store(output_dir, track_ids, load_analysis, progress=None, quantize=False) -> list:
+    """
+    Packs the analyses of track_ids into a store in output_dir. Segment rows are streamed to disk, so the dataset
+    never has to fit in memory. Returns the ids that could not be loaded and were left out.
+    """
+    store_dir = get_store_dir(output_dir)
+    if not exists(store_dir):
+        makedirs(store_dir)
+    pitches_path = join(store_dir, 'pitches.raw')
+    segments_path = join(store_dir, 'segments.raw')
+    offsets = [0]
+    labels = []
+    packed_ids = []
+    skipped = []
+    with open(pitches_path, 'wb') as raw_pitches, open(segments_path, 'wb') as raw_segments:
+        for track_id in track_ids:
+            try:
+                analysis = load_analysis(track_id)
+            except FileNotFoundError:
+                skipped.append(track_id)
+                continue
+            segments = get_segment_rows(analysis)
+            raw_pitches.write(get_pitch_rows(analysis, quantize).tobytes())
+            raw_segments.write(segments.tobytes())
+            offsets.append(offsets[-1] + len(segments))
+            labels.append(get_label(analysis))
+            packed_ids.append(track_id)
+            if progress is not None:
+                progress(len(packed_ids))
+
+    n_rows = offsets[-1]
+    raw_to_npy(pitches_path, join(store_dir, 'pitches.npy'), np.uint8 if quantize else np.float32, (n_rows, 12))
+    raw_to_npy(segments_path, join(store_dir, 'segments.npy'), np.float32, (n_rows, N_COLUMNS))
+    if exists(join(store_dir, 'values.npy')):
+        remove(join(store_dir, 'values.npy'))
+    np.save(join(store_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(join(store_dir, 'labels.npy'), np.array(labels, dtype=LABEL_DTYPE))
+    np.save(join(store_dir, 'track_ids.npy'), np.array(packed_ids, dtype=str))
+    write_features(PackedStore.open(output_dir), store_dir)
+    return skipped
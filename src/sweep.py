@@ -0,0 +1,153 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from os import makedirs
+from os.path import dirname, join
+from time import perf_counter, process_time
+
+import numpy as np
+from tabulate import tabulate
+
+import key_recognition
+from key_recognition import attach_shared_store, load_shared_data, run_fold, set_shared_store
+
+
+def get_args():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--data-dir', default='dataset', type=str, help='''
+        The directory where the track data is stored to use for the sweep.
+        ''')
+    arg_parser.add_argument('--n_components', default=[3], type=int, nargs='+', help='''
+        Amounts of components ('hidden states') to sweep over.
+        ''')
+    arg_parser.add_argument('--n_iter', default=[100], type=int, nargs='+', help='''
+        (Maximum) amounts of HMM training iterations to sweep over.
+        ''')
+    arg_parser.add_argument('--mixture', action='store_true', help='''
+        Use a Gaussian mixture model
+        ''')
+    arg_parser.add_argument('--folds', default=10, type=int, help='''
+        Amount of cross-validation folds to run for every configuration.
+        ''')
+    arg_parser.add_argument('--subset', default=0, type=int, help='''
+        Only use the first N tracks of the track list. Uses all tracks when 0.
+        ''')
+    arg_parser.add_argument('--give-mode', action='store_true', help='''
+        Test the models with given mode (major/minor).
+        ''')
+    arg_parser.add_argument('--window-seconds', default=20, type=float, help='''
+        Only use the segments of the first N seconds of every track. Uses the whole track when 0.
+        ''')
+    arg_parser.add_argument('--workers', default=10, type=int, help='''
+        Amount of processes to run the (configuration, fold) jobs in.
+        ''')
+    arg_parser.add_argument('--output', default='results/sweep.csv', type=str, help='''
+        CSV file to write the summary table of all configurations to.
+        ''')
+    arg_parser.add_argument('--confusion-dir', default='', type=str, help='''
+        Optional directory to store the confusion matrix of every (configuration, fold) job in.
+        ''')
+    return arg_parser.parse_args()
+
+
+def get_fold_args(sweep_args, n_components, n_iter):
+    argv = ['--data-dir', sweep_args.data_dir, '--test-split', str(sweep_args.folds),
+            '--n_components', str(n_components), '--n_iter', str(n_iter),
+            '--window-seconds', str(sweep_args.window_seconds)]
+    if sweep_args.subset > 0:
+        argv += ['--dry', '--subset', str(sweep_args.subset)]
+    if sweep_args.give_mode:
+        argv += ['--give-mode']
+    # The sweep's pool already keeps every core busy
+    argv += ['hmm', '--train-workers', '1']
+    if sweep_args.mixture:
+        argv += ['--mixture']
+    return key_recognition.get_args(argv)
+
+
+def job_cost(args):
+    # EM cost grows with the amount of iterations and, through the transition and emission terms, with the states
+    return args.n_iter * args.n_components ** 2 * (10 if args.mixture else 1)
+
+
+def run_job(args, rows, fold):
+    start, start_cpu = perf_counter(), process_time()
+    error, _, confusion_matrix = run_fold(args, rows, fold)
+    return error, confusion_matrix, perf_counter() - start, process_time() - start_cpu
+
+
+def run_sweep(sweep_args, verbose=True):
+    '''
+    Runs every (configuration, fold) job of the grid in a process pool that shares one loaded dataset, most expensive
+    jobs first. Returns the configurations and, per configuration, the results of its folds in fold order.
+    '''
+    configs = [get_fold_args(sweep_args, n_components, n_iter)
+               for n_components, n_iter in product(sweep_args.n_components, sweep_args.n_iter)]
+    jobs = sorted(product(range(len(configs)), range(sweep_args.folds)),
+                  key=lambda job: job_cost(configs[job[0]]), reverse=True)
+    store, rows, spec, blocks = load_shared_data(sweep_args.data_dir, dry=sweep_args.subset > 0,
+                                                 subset=sweep_args.subset)
+    results = [[None] * sweep_args.folds for _ in configs]
+    executor = None
+    futures = {}
+    try:
+        if sweep_args.workers <= 1:
+            set_shared_store(store)
+            completed = ((job, run_job(configs[job[0]], rows, job[1])) for job in jobs)
+        else:
+            executor = ProcessPoolExecutor(max_workers=sweep_args.workers, initializer=attach_shared_store,
+                                           initargs=(spec,))
+            futures = {executor.submit(run_job, configs[config], rows, fold): (config, fold)
+                       for config, fold in jobs}
+            completed = ((futures[future], future.result()) for future in as_completed(futures))
+        for n, ((config, fold), result) in enumerate(completed):
+            results[config][fold] = result
+            if verbose:
+                print(f"[{n + 1}/{len(jobs)}] n_components={configs[config].n_components}, "
+                      f"n_iter={configs[config].n_iter}, fold={fold}: error {100 * result[0]:.2f}%, "
+                      f"{result[2]:.1f}s")
+    finally:
+        # The workers are attached to the shared memory blocks, so they are stopped before the blocks are unlinked
+        # (cancelling the queued jobs by hand, as shutdown() only takes cancel_futures from Python 3.9)
+        if executor is not None:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return configs, results
+
+
+def summarize(configs, results):
+    summary = []
+    for args, fold_results in zip(configs, results):
+        errors = np.array([error for error, _, _, _ in fold_results])
+        walltimes = np.array([walltime for _, _, walltime, _ in fold_results])
+        cputimes = np.array([cputime for _, _, _, cputime in fold_results])
+        summary.append([args.n_components, args.n_iter, args.mixture, len(fold_results), 100 * errors.mean(),
+                        100 * errors.std(), walltimes.mean(), walltimes.sum(), cputimes.sum()])
+    return summary
+
+
+summary_headers = ['n_components', 'n_iter', 'mixture', 'folds', 'error', 'error_std', 'walltime_fold',
+                   'walltime_total', 'cputime_total']
+
+
+if __name__ == '__main__':
+    sweep_args = get_args()
+    configs, results = run_sweep(sweep_args)
+    summary = summarize(configs, results)
+    print(tabulate(summary, headers=summary_headers, floatfmt='.2f'))
+    if dirname(sweep_args.output):
+        makedirs(dirname(sweep_args.output), exist_ok=True)
+    with open(sweep_args.output, 'w') as f:
+        f.write(','.join(summary_headers) + '\n')
+        for row in summary:
+            f.write(','.join(str(value) for value in row) + '\n')
+    if sweep_args.confusion_dir:
+        makedirs(sweep_args.confusion_dir, exist_ok=True)
+        for args, fold_results in zip(configs, results):
+            for fold, (_, confusion_matrix, _, _) in enumerate(fold_results):
+                filename = 'n_components={},n_iter={},fold={}.csv'.format(args.n_components, args.n_iter, fold)
+                np.savetxt(join(sweep_args.confusion_dir, filename), confusion_matrix)
@@ -1,60 +1,42 @@
-from time import sleep, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from time import time
 
-from dateutil.parser import parse
-from requests import get
+from constants import get_api_url
+from spotify_client import SpotifyClient
 
-from authorize import get_token
 
-track_analysis_endpoint = 'https://api.spotify.com/v1/audio-analysis'
-
-
-def isfloat(flt):
-    try:
-        float(flt)
-        return True
-    except ValueError:
-        return False
-
-
-def process_retry(retry_after):
-    # It is either a float  or an HTTP date
-    if not isfloat(retry_after):
-        retry_after = parse(retry_after).timestamp() - time()
-    sleep(retry_after)
+def _get_track_analysis_url(track_id):
+    return f'{get_api_url()}/audio-analysis/{track_id}'
 
 
-def _get_track_analysis_url(track_id):
-    return f'{track_analysis_endpoint}/{track_id}'
+def n_track_analyses_generator(track_ids, concurrency=8, rate=20.0, client=None):
+    """
+    Fetches the audio analysis of every track with `concurrency` threads, at most `rate` requests per second. Results
+    are yielded in order of completion, tracks that were not found as {'track_not_found': track_id}.
+    """
+    if client is None:
+        client = SpotifyClient(concurrency, rate)
 
+    def fetch(track_id):
+        response = client.get(_get_track_analysis_url(track_id))
+        if response.status_code == 404:
+            print(f"received 404 for track {track_id}.")
+            return {'track_not_found': track_id}
+        result = response.json()
+        result['track']['id'] = track_id
+        return result
 
-def n_track_analyses_generator(track_ids):
-    token = get_token()
-    headers = {'Authorization': f"{token['token_type']} {token['access_token']}"}
-    idx = 0
     start_time = time()
-    while True:
-        if idx == len(track_ids):
-            break
-        track_id = track_ids[idx]
-        response = get(_get_track_analysis_url(track_id), headers=headers)
-        if response.status_code == 429:
-            print(f'we were rate limited after {idx + 1} requests')
-        if response.status_code == 200:
-            result = response.json()
-            result['track']['id'] = track_id
-            yield result
-            idx += 1
-        elif 'Retry-After' in headers:
-            print(f"Got status code {response.status_code} with a Retry-After header. Retrying after {headers['Retry-After']}")
-            process_retry(headers['Retry-After'])
-        elif response.status_code == 404:
-            print(f"received 404 for track {track_id}.")
-            track_ids.remove(track_id)
-            result = {'track_not_found': track_id}
-            yield result
-        else:
-            print(response)
-            print(response.json())
-            raise Exception("Unexpected non-200 status code")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Keep a bounded amount of requests in flight rather than submitting all track ids at once
+        ids = iter(track_ids)
+        pending = {executor.submit(fetch, track_id) for track_id in islice(ids, 2 * concurrency)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                for track_id in islice(ids, 1):
+                    pending.add(executor.submit(fetch, track_id))
     total_time = time() - start_time
     print(f'fetched {len(track_ids)} track analysis objects in {total_time:.3f} seconds')
@@ -1,4 +1,6 @@
-from os.path import join
+from hashlib import sha1
+from os import remove
+from os.path import exists, join
 from pathlib import Path
 from dill import dump, load
 
@@ -36,9 +38,21 @@ class TrackList:
     def dump(self, output_dir):
         with open(join(output_dir, 'track_list.pickle'), 'wb') as f:
             dump(self, f)
+        # The full dump supersedes the checkpoint
+        if exists(join(output_dir, 'track_list.log')):
+            remove(join(output_dir, 'track_list.log'))
+
+    def checkpoint(self, output_dir, track_ids):
+        """
+        Appends track ids that were added since the last dump to track_list.log, which load() replays. Much cheaper than
+        dumping the whole list every time.
+        """
+        with open(join(output_dir, 'track_list.log'), 'a') as f:
+            f.writelines(f'{track_id}\n' for track_id in track_ids)
 
     def hash(self):
-        return hash(''.join(sorted(self.track_ids)))
+        # Stable between runs, unlike hash() on a str
+        return sha1(''.join(sorted(self.track_ids)).encode()).hexdigest()
 
     @classmethod
     def load_from_dir(cls, output_dir):
@@ -47,4 +61,12 @@ class TrackList:
     @classmethod
     def load(cls, path):
         with open(path, 'rb') as f:
-            return load(f)
+            track_list = load(f)
+        log_path = Path(path).with_suffix('.log')
+        if log_path.exists():
+            with open(log_path, 'r') as f:
+                for line in f:
+                    track_id = line.strip()
+                    if track_id and not track_list.have_track_id(track_id):
+                        track_list.add_track_id(track_id)
+        return track_list